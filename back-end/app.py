@@ -2,9 +2,11 @@
 # The main features include:
 # 1. CORS (Cross-Origin Resource Sharing) support to allow requests from different origins.
 # 2. Session management and security settings such as session timeout, HTTP-only cookies, and secret keys.
-# 3. Registration of blueprints for handling different routes (main, authentication, and file operations).
+# 3. Registration of blueprints for handling different routes (main, authentication, file operations, chunked uploads, index queries, profiling and scheduling).
 # 4. Initialization of an SQLite database for user management (username and hashed password storage).
 # 5. Loading a pre-trained TensorFlow model for processing with custom layers.
+# 6. Bounding the number of concurrent pipeline executions and sharing them fairly between users (see routes.backpressure).
+# For production, serve the app with gunicorn (see wsgi.py and gunicorn.conf.py) instead of the debug server below.
 
 
 from flask import Flask
@@ -16,18 +18,43 @@ import logging as rel_log
 import os
 import sqlite3
 from custom_layers import custom_objects
+from core import process
+from core.inference import CompiledPredictor
+from core.tile_cache import TileCache, model_version
+from core.remote import RemotePredictor
 from routes.main import main_bp
 from routes.auth import auth_bp
 from routes.file_operations import file_ops_bp
+from routes.chunked_upload import chunked_upload_bp
+from routes.index_query import index_query_bp
+from routes.profiling import profiling_bp
+from routes.backpressure import backpressure_bp, create_pipeline_scheduler
 
 # Configuration settings for the DPIRD Intellicrop project
 UPLOAD_FOLDER = r'./uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'tif', 'zip'}
+EXPORT_FOLDER = r'./tmp/export'
+RESULT_FOLDER = r'./tmp/results'  # Full-resolution results of progressive uploads
+PROGRESSIVE_BACKLOG = int(os.environ.get('PROGRESSIVE_BACKLOG', 4))  # Full-resolution runs queued or running per worker
+PROFILE_FOLDER = r'./tmp/profiles'  # Stored per-request profiles
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')  # Admin token enabling per-request profiling; disabled when unset
+TILE_CACHE_FOLDER = r'./tmp/tile_cache'
+INFERENCE_WORKERS = [url for url in os.environ.get('INFERENCE_WORKERS', '').split(',') if url]  # Remote inference workers; local model when empty
+TILE_CACHE_MAX_MB = int(os.environ.get('TILE_CACHE_MAX_MB', 512))  # Size budget of the tile prediction cache for resubmitted uploads; 0 disables it
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024  # Largest chunk accepted by the resumable upload API
+MAX_CONCURRENT_PIPELINES = int(os.environ.get('MAX_CONCURRENT_PIPELINES', 2))  # Pipelines running at once, across all workers
+PIPELINE_QUEUE_TIMEOUT = float(os.environ.get('PIPELINE_QUEUE_TIMEOUT', 5))  # Seconds a request may wait behind other uploads
+PIPELINE_SCHEDULED_TIMEOUT = float(os.environ.get('PIPELINE_SCHEDULED_TIMEOUT', 120))  # Seconds a request may wait in total once next in line
+PIPELINE_RETRY_AFTER = 30  # Seconds suggested to clients turned away with 429
+SCHEDULER_FOLDER = r'./tmp/scheduler'  # Pipeline scheduler state shared by the workers
+MODEL_PATH = 'model1.h5'
+MODEL_JIT_COMPILE = os.environ.get('MODEL_JIT_COMPILE', '0') == '1'  # Compile the inference graphs with XLA
+REQUIRED_DIRECTORIES = ['uploads', 'tmp/ct', 'tmp/draw', 'tmp/image', 'tmp/mask', 'tmp/uploads', 'tmp/export', 'tmp/results', 'tmp/profiles']
 
 def create_app():
     """
     Creates and configures the Flask application, including CORS settings, secret keys, and session configurations.
-    Registers blueprints for main, auth, and file operations routes.
+    Registers blueprints for main, auth, file operations, chunked upload, index query, profiling and scheduler routes.
 
     Returns:
     Flask app object: Configured Flask app ready to run.
@@ -38,6 +65,15 @@ def create_app():
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'you-should-change-this'
     app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
     app.config['ALLOWED_EXTENSIONS'] = ALLOWED_EXTENSIONS
+    app.config['EXPORT_FOLDER'] = EXPORT_FOLDER
+    app.config['RESULT_FOLDER'] = RESULT_FOLDER
+    app.config['PROGRESSIVE_BACKLOG'] = PROGRESSIVE_BACKLOG
+    app.config['PROFILE_FOLDER'] = PROFILE_FOLDER
+    app.config['PROFILE_TOKEN'] = PROFILE_TOKEN
+    app.config['UPLOAD_CHUNK_SIZE'] = UPLOAD_CHUNK_SIZE
+    app.config['PIPELINE_QUEUE_TIMEOUT'] = PIPELINE_QUEUE_TIMEOUT
+    app.config['PIPELINE_SCHEDULED_TIMEOUT'] = PIPELINE_SCHEDULED_TIMEOUT
+    app.config['PIPELINE_RETRY_AFTER'] = PIPELINE_RETRY_AFTER
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = timedelta(seconds=1)
     app.config['SESSION_COOKIE_SECURE'] = True
     app.config['SESSION_COOKIE_HTTPONLY'] = True
@@ -50,10 +86,20 @@ def create_app():
     # Initialize the database
     init_db()
 
+    # The tile prediction cache needs the model version, so it is created with the model in prepare_app()
+    app.tile_cache = None
+
+    # Shared, fair limit on concurrent pipelines; created here, before the workers are forked, as it resets the shared state
+    app.pipeline_scheduler = create_pipeline_scheduler(MAX_CONCURRENT_PIPELINES, SCHEDULER_FOLDER)
+
     # Register blueprints for various routes
     app.register_blueprint(main_bp)
     app.register_blueprint(auth_bp)
     app.register_blueprint(file_ops_bp)
+    app.register_blueprint(chunked_upload_bp)
+    app.register_blueprint(index_query_bp)
+    app.register_blueprint(profiling_bp)
+    app.register_blueprint(backpressure_bp)
 
     @app.after_request
     def after_request(response):
@@ -68,8 +114,8 @@ def create_app():
         """
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Credentials'] = 'true'
-        response.headers['Access-Control-Allow-Methods'] = 'POST'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-Requested-With'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-Requested-With, X-Profile-Token, X-Chunk-SHA256'
         return response
 
     return app
@@ -91,18 +137,64 @@ def init_db():
     conn.commit()
     conn.close()
 
-if __name__ == '__main__':
-    # Create the Flask app
-    app = create_app()
+def prepare_app(app, load=True):
+    """
+    Creates the working directories and the tile prediction cache, and loads the model onto the app unless `load` is False.
+    The cache is keyed by a hash of the model file, so creating it needs no TensorFlow.
+    If INFERENCE_WORKERS is set, a predictor that sends tiles to those worker nodes is used instead (see core.remote).
 
+    Parameters:
+    app (Flask app object): The app returned by create_app().
+    load (bool): If True, load the model now with load_app_model(). Must be False before forking workers, as the
+                 TensorFlow runtime and the CUDA driver do not survive fork(); each worker then loads the model
+                 after the fork (see gunicorn.conf.py). Default is True.
+
+    Returns:
+    Flask app object: The same app, with the `model` attribute set (None until loaded).
+    """
     # Ensure the necessary directories exist
-    for directory in ['uploads', 'tmp/ct', 'tmp/draw', 'tmp/image', 'tmp/mask', 'tmp/uploads']:
+    for directory in REQUIRED_DIRECTORIES:
         os.makedirs(directory, exist_ok=True)
 
-    # Load the TensorFlow model with custom layers
+    # Send tile inference to the worker nodes instead of loading the model here (see inference_worker.py)
+    if INFERENCE_WORKERS:
+        app.model = RemotePredictor(INFERENCE_WORKERS)
+        if TILE_CACHE_MAX_MB > 0:
+            app.tile_cache = TileCache(TILE_CACHE_FOLDER, TILE_CACHE_MAX_MB * 1024 ** 2, app.model.info()['model_version'])
+    else:
+        app.model = None
+        if TILE_CACHE_MAX_MB > 0:
+            app.tile_cache = TileCache(TILE_CACHE_FOLDER, TILE_CACHE_MAX_MB * 1024 ** 2, model_version(MODEL_PATH))
+
+    if load:
+        load_app_model(app)
+    return app
+
+def load_app_model(app):
+    """
+    Loads the TensorFlow model with custom layers onto the app, wrapped in a compiled, shape-specialised predictor
+    (see core.inference), and runs the inference graph once per padded batch size so that no upload pays for tracing.
+    With remote inference workers, only checks that they answer.
+    When serving with gunicorn this runs in every worker after the fork. The model is small, so each worker holding
+    its own copy costs little, and nothing of the TensorFlow runtime is shared across fork().
+
+    Parameters:
+    app (Flask app object): The app returned by prepare_app().
+    """
+    if INFERENCE_WORKERS:
+        app.model.warm_up()
+        return
+
     with app.app_context():
+        process.configure_gpus()
         custom_objects['mse'] = tf.keras.losses.mse  # Adding custom loss function
-        app.model = load_model('model1.h5', custom_objects=custom_objects)  # Load pre-trained model
+        model = load_model(MODEL_PATH, custom_objects=custom_objects)  # Load pre-trained model
+        app.model = CompiledPredictor(model, jit_compile=MODEL_JIT_COMPILE)
+        app.model.warm_up()
+
+if __name__ == '__main__':
+    # Create the Flask app and load the model
+    app = prepare_app(create_app())
 
     # Run the Flask app on localhost at port 5003
     app.run(host='127.0.0.1', port=5003, debug=True)
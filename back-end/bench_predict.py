@@ -0,0 +1,65 @@
+# This script benchmarks the inference latency of the DPIRD Intellicrop segmentation model.
+# It compares Keras' generic `model.predict` with the compiled, shape-specialised predictor in core.inference,
+# with and without XLA, and reports p50/p99 latency in milliseconds for each.
+#
+# Run from the back-end directory with:
+#     python bench_predict.py --runs 50 --batch-size 1
+
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+from custom_layers import custom_objects
+from core.inference import CompiledPredictor
+
+
+def measure(predict, X, runs, warm_up_runs=3):
+    """
+    Measure the latency of a predict function.
+
+    Parameters:
+    predict (function): The function to call with the input batch.
+    X (numpy.ndarray): The input batch.
+    runs (int): Number of timed calls.
+    warm_up_runs (int): Number of untimed calls made first. Default is 3.
+
+    Returns:
+    tuple: The p50 and p99 latency in milliseconds.
+    """
+    for _ in range(warm_up_runs):
+        predict(X)
+
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predict(X)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare model.predict with the compiled predictor.')
+    parser.add_argument('--model', default='model1.h5', help='Path to the Keras model.')
+    parser.add_argument('--runs', type=int, default=50, help='Number of timed calls per variant.')
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of samples per call.')
+    args = parser.parse_args()
+
+    custom_objects['mse'] = tf.keras.losses.mse
+    model = load_model(args.model, custom_objects=custom_objects)
+    X = np.random.rand(args.batch_size, *model.input_shape[1:]).astype(np.float32)
+
+    variants = {
+        'model.predict': lambda x: model.predict(x, verbose=0),
+        'compiled': CompiledPredictor(model).predict,
+        'compiled + XLA': CompiledPredictor(model, jit_compile=True).predict,
+    }
+
+    print(f"Input shape {X.shape}, {args.runs} runs per variant")
+    print(f"{'variant':<16}{'p50 (ms)':>12}{'p99 (ms)':>12}")
+    for name, predict in variants.items():
+        p50, p99 = measure(predict, X, args.runs)
+        print(f"{name:<16}{p50:>12.2f}{p99:>12.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# This script exports the predicted mask in formats that downstream spray controllers and GIS tools can consume.
+# The main steps include:
+# 1. Recovering the georeference (CRS and transform) of the index rasters the prediction was made from.
+# 2. Quantizing the float mask (-1 to 1) to int8 scores or a uint8 class map and writing it as a compressed, tiled GeoTIFF.
+# 3. Vectorizing the weed areas into simplified polygons and writing them as a GeoJSON prescription map
+#    in WGS84 longitude/latitude, as RFC 7946 requires.
+
+import json
+import os
+import numpy as np
+import rasterio
+import rasterio.features
+import rasterio.warp
+from rasterio.transform import Affine
+
+# Thresholds shared with core.main.color_distribution
+WEED_THRESHOLD = -0.1
+VEGETATION_THRESHOLD = 0.1
+
+# Class values used in the uint8 class map
+CLASS_OTHER = 0
+CLASS_WEED = 1
+CLASS_VEGETATION = 2
+
+# Nodata values for the quantized rasters
+NODATA = {'int8': -128, 'uint8': 255}
+
+EXPORT_FORMATS = ('geotiff', 'geojson')
+
+
+def reference_profile(data_path, shape):
+    """
+    Find the georeference of the index rasters in the given directory and adapt it to the mask shape.
+
+    Parameters:
+    data_path (str): The directory containing the index .tif files the prediction was made from.
+    shape (tuple): The (height, width) of the predicted mask.
+
+    Returns:
+    dict: A dictionary with 'crs' and 'transform' keys. Both are None if no raster was found.
+    """
+    for file in sorted(os.listdir(data_path)):
+        if not file.endswith('.tif'):
+            continue
+        with rasterio.open(os.path.join(data_path, file)) as src:
+            transform = src.transform
+            # The model may predict at a different resolution than the inputs; stretch the pixel size to cover the same extent
+            if (src.height, src.width) != tuple(shape):
+                transform = transform * Affine.scale(src.width / shape[1], src.height / shape[0])
+            return {'crs': src.crs, 'transform': transform}
+
+    return {'crs': None, 'transform': None}
+
+def quantize_mask(mask, dtype='int8'):
+    """
+    Quantize a float mask in the range -1 to 1.
+
+    Parameters:
+    mask (numpy.ndarray): The predicted mask array.
+    dtype (str): 'int8' keeps the score scaled to -127..127, 'uint8' produces a class map
+                 (0 other, 1 weed, 2 vegetation). Default is 'int8'.
+
+    Returns:
+    numpy.ndarray: The quantized mask, with NaN pixels set to the nodata value.
+    """
+    invalid = ~np.isfinite(mask)
+
+    if dtype == 'int8':
+        quantized = np.rint(np.clip(np.nan_to_num(mask), -1, 1) * 127).astype(np.int8)
+    elif dtype == 'uint8':
+        quantized = np.full(mask.shape, CLASS_OTHER, dtype=np.uint8)
+        quantized[mask < WEED_THRESHOLD] = CLASS_WEED
+        quantized[mask > VEGETATION_THRESHOLD] = CLASS_VEGETATION
+    else:
+        raise ValueError(f"Unsupported quantization dtype: {dtype}")
+
+    quantized[invalid] = NODATA[dtype]
+    return quantized
+
+def save_mask_geotiff(mask, tif_path, profile, dtype='int8'):
+    """
+    Save the predicted mask as a quantized, compressed and tiled GeoTIFF.
+
+    Parameters:
+    mask (numpy.ndarray): The predicted mask array.
+    tif_path (str): Path of the output .tif file.
+    profile (dict): Georeference with 'crs' and 'transform' keys, as returned by reference_profile().
+    dtype (str): 'int8' or 'uint8', see quantize_mask(). Default is 'int8'.
+
+    Returns:
+    str: The path of the written file.
+    """
+    quantized = quantize_mask(mask, dtype)
+    height, width = quantized.shape
+
+    options = {'compress': 'deflate', 'zlevel': 9}
+    if dtype == 'int8':
+        options['predictor'] = 2  # Horizontal differencing helps deflate on smooth scores
+    if height >= 256 and width >= 256:
+        options.update(tiled=True, blockxsize=256, blockysize=256)
+
+    with rasterio.open(
+            tif_path, 'w', driver='GTiff', height=height, width=width, count=1, dtype=dtype,
+            crs=profile['crs'], transform=profile['transform'] or Affine.identity(),
+            nodata=NODATA[dtype], **options
+    ) as dst:
+        dst.write(quantized, 1)
+        if dtype == 'uint8':
+            dst.write_colormap(1, {CLASS_OTHER: (255, 255, 255, 255), CLASS_WEED: (255, 0, 0, 255),
+                                   CLASS_VEGETATION: (0, 255, 0, 255)})
+    print(f'Saved {tif_path}')
+    return tif_path
+
+def simplify_ring(ring, tolerance):
+    """
+    Simplify a closed polygon ring with the Douglas-Peucker algorithm.
+
+    Parameters:
+    ring (list): The ring coordinates as (x, y) tuples, first and last point equal.
+    tolerance (float): Maximum distance, in CRS units, a removed point may lie from the simplified ring.
+
+    Returns:
+    list: The simplified ring, or None if it collapsed to fewer than three distinct points.
+    """
+    points = np.asarray(ring, dtype=np.float64)
+    if tolerance <= 0 or len(points) <= 4:
+        return [tuple(p) for p in points]
+
+    keep = np.zeros(len(points), dtype=bool)
+    # Anchor the ring at its first point and the point farthest from it so both halves are open polylines
+    far = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    keep[[0, far, len(points) - 1]] = True
+    stack = [(0, far), (far, len(points) - 1)]
+
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(*offsets.T)
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        split = int(np.argmax(distances))
+        if distances[split] > tolerance:
+            split += start + 1
+            keep[split] = True
+            stack.extend([(start, split), (split, end)])
+
+    simplified = points[keep]
+    if len(simplified) < 4:
+        return None
+    return [tuple(p) for p in simplified]
+
+def weed_polygons(mask, profile, min_pixels=4, tolerance=None):
+    """
+    Vectorize the weed areas of the predicted mask into simplified polygons.
+
+    Parameters:
+    mask (numpy.ndarray): The predicted mask array.
+    profile (dict): Georeference with 'crs' and 'transform' keys, as returned by reference_profile().
+    min_pixels (int): Weed patches smaller than this number of pixels are removed before vectorizing. Default is 4.
+    tolerance (float): Simplification tolerance in CRS units. Default is one pixel.
+
+    Returns:
+    list: A list of GeoJSON Feature dictionaries.
+    """
+    transform = profile['transform'] or Affine.identity()
+    if tolerance is None:
+        tolerance = abs(transform.a)
+
+    weeds = (np.nan_to_num(mask) < WEED_THRESHOLD).astype(np.uint8)
+    if min_pixels > 1:
+        weeds = rasterio.features.sieve(weeds, size=min_pixels)
+
+    features = []
+    for geometry, value in rasterio.features.shapes(weeds, mask=weeds.astype(bool), transform=transform):
+        rings = [simplify_ring(ring, tolerance) for ring in geometry['coordinates']]
+        if rings[0] is None:
+            continue  # The outer ring collapsed, drop the whole patch
+        features.append({
+            'type': 'Feature',
+            'properties': {'class': 'weed'},
+            'geometry': {'type': 'Polygon', 'coordinates': [ring for ring in rings if ring is not None]}
+        })
+
+    return features
+
+def save_weed_geojson(mask, geojson_path, profile, min_pixels=4, tolerance=None):
+    """
+    Save the weed areas of the predicted mask as an RFC 7946 GeoJSON FeatureCollection.
+    The polygons are simplified in the CRS of the mask and then reprojected to WGS84 longitude/latitude.
+
+    Parameters:
+    mask (numpy.ndarray): The predicted mask array.
+    geojson_path (str): Path of the output .geojson file.
+    profile (dict): Georeference with 'crs' and 'transform' keys, as returned by reference_profile().
+    min_pixels (int): See weed_polygons(). Default is 4.
+    tolerance (float): See weed_polygons(). Default is one pixel.
+
+    Returns:
+    str: The path of the written file.
+    """
+    features = weed_polygons(mask, profile, min_pixels, tolerance)
+    if profile['crs'] is not None and profile['crs'] != rasterio.crs.CRS.from_epsg(4326):
+        for feature in features:
+            feature['geometry'] = rasterio.warp.transform_geom(profile['crs'], 'EPSG:4326', feature['geometry'])
+    collection = {'type': 'FeatureCollection', 'features': features}
+
+    with open(geojson_path, 'w') as f:
+        json.dump(collection, f, separators=(',', ':'))
+    print(f'Saved {geojson_path} with {len(collection["features"])} weed polygons')
+    return geojson_path
+
+def export_mask(mask, data_path, export_folder, pid, formats=EXPORT_FORMATS, dtype='int8'):
+    """
+    Export the predicted mask in the requested formats.
+
+    Parameters:
+    mask (numpy.ndarray): The predicted mask array.
+    data_path (str): The directory containing the index .tif files the prediction was made from.
+    export_folder (str): Path to the folder where the exports will be written.
+    pid (str): Unique identifier of the prediction, used to name the files.
+    formats (iterable): Any of 'geotiff' and 'geojson'. Default is both.
+    dtype (str): Quantization of the GeoTIFF, see quantize_mask(). Default is 'int8'.
+
+    Returns:
+    dict: A dictionary mapping each format to the name of the written file inside export_folder.
+    """
+    unknown = set(formats) - set(EXPORT_FORMATS)
+    if unknown:
+        raise ValueError(f"Unsupported export formats: {sorted(unknown)}")
+
+    os.makedirs(export_folder, exist_ok=True)
+    profile = reference_profile(data_path, mask.shape)
+    exports = {}
+
+    if 'geotiff' in formats:
+        exports['geotiff'] = f'{pid}_mask.tif'
+        save_mask_geotiff(mask, os.path.join(export_folder, exports['geotiff']), profile, dtype)
+    if 'geojson' in formats:
+        exports['geojson'] = f'{pid}_weeds.geojson'
+        save_weed_geojson(mask, os.path.join(export_folder, exports['geojson']), profile)
+
+    return exports
@@ -0,0 +1,115 @@
+# This script provides a compiled, shape-specialised inference path for the DPIRD Intellicrop segmentation model.
+# Keras' generic `model.predict` builds a data adapter and may retrace its graph on every call, which dominates the
+# latency of the single small batches served by the web app. The predictor here instead:
+# 1. Wraps the model call in one tf.function per input shape, each with a fixed input signature so it never retraces.
+# 2. Pads batches to a small set of sizes (1, 2, 4, ...) so that a handful of graphs serve every request.
+# 3. Optionally compiles the graphs with XLA, which also helps on CPU.
+# 4. Runs a warm-up pass so that tracing and compilation happen before the first real request.
+
+import threading
+import numpy as np
+import tensorflow as tf
+
+
+class CompiledPredictor:
+    """
+    Drop-in replacement for a Keras model in the prediction pipeline: it exposes `predict` and `input_shape`,
+    and forwards any other attribute to the wrapped model.
+    """
+
+    def __init__(self, model, max_batch_size=8, jit_compile=False):
+        """
+        Parameters:
+        model (keras.Model): The loaded segmentation model.
+        max_batch_size (int): Largest batch run in one call; bigger inputs are split. Default is 8.
+        jit_compile (bool): If True, compile the graphs with XLA. Default is False.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.jit_compile = jit_compile
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    @property
+    def input_shape(self):
+        return self.model.input_shape
+
+    def _function_for(self, shape):
+        """
+        Return the compiled function for an input shape, creating it on first use.
+
+        Parameters:
+        shape (tuple): The full input shape, including the batch size.
+
+        Returns:
+        tf.types.experimental.GenericFunction: The function specialised to that shape.
+        """
+        with self._lock:
+            function = self._functions.get(shape)
+            if function is None:
+                model = self.model
+                function = tf.function(lambda x: model(x, training=False),
+                                       input_signature=[tf.TensorSpec(shape, tf.float32)],
+                                       jit_compile=self.jit_compile)
+                self._functions[shape] = function
+        return function
+
+    def _padded_size(self, batch_size):
+        """
+        Return the smallest compiled batch size, a power of two up to max_batch_size, that fits the batch.
+
+        Parameters:
+        batch_size (int): The number of samples in the batch.
+
+        Returns:
+        int: The padded batch size.
+        """
+        padded = 1
+        while padded < batch_size:
+            padded *= 2
+        return min(padded, self.max_batch_size)
+
+    def predict(self, X, verbose=0, **kwargs):
+        """
+        Run the model on a batch, like keras.Model.predict.
+
+        Parameters:
+        X (numpy.ndarray): The input batch with shape (num_samples, height, width, num_channels).
+        verbose (int): Accepted for compatibility with keras.Model.predict and ignored.
+
+        Returns:
+        numpy.ndarray: The model output for each sample.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        outputs = []
+
+        for start in range(0, X.shape[0], self.max_batch_size):
+            batch = X[start:start + self.max_batch_size]
+            size = len(batch)
+            padded = self._padded_size(size)
+            if padded > size:
+                batch = np.concatenate([batch, np.zeros((padded - size,) + batch.shape[1:], dtype=np.float32)])
+
+            result = self._function_for(batch.shape)(tf.constant(batch))
+            outputs.append(result.numpy()[:size])
+
+        return np.concatenate(outputs)
+
+    def warm_up(self, batch_sizes=None):
+        """
+        Trace, compile and run the graphs for the given batch sizes once, so the first request does not pay for it.
+
+        Parameters:
+        batch_sizes (iterable): The batch sizes to prepare. Default is every padded size predict() may use,
+                                i.e. the powers of two up to max_batch_size.
+        """
+        if batch_sizes is None:
+            batch_sizes = range(1, self.max_batch_size + 1)
+        for batch_size in sorted({self._padded_size(b) for b in batch_sizes}):
+            shape = (self._padded_size(batch_size),) + tuple(self.model.input_shape[1:])
+            self._function_for(shape)(tf.zeros(shape, tf.float32))
+        print(f"Warmed up inference for input shapes {sorted(self._functions)}"
+              f"{' with XLA' if self.jit_compile else ''}")
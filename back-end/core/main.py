@@ -5,17 +5,25 @@
 # 3. Applying a custom colormap to display predictions, where red represents weeds, green represents vegetation, and white represents neutral areas.
 # 4. Calculating the distribution of these colors in the predicted mask.
 # 5. Saving the original and predicted images for analysis.
+# 6. Running a quick prediction on low-resolution indices for a progressive preview.
+# 7. Optionally exporting the mask as a quantized GeoTIFF and weed polygons as GeoJSON (see core.export).
 # The code also handles model predictions and generates a unique identifier for each prediction.
+# Predictions are made tile by tile at the model input size, optionally skipping tiles without vegetation (see core.sparse)
+# and reusing cached predictions of identical tiles (see core.tile_cache).
 
 from core import process
+from core import export
+from core import tiling
+from core import sparse
+from core.normalize import normalize_index, NAN_FILL_VALUE
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
+import matplotlib.image as mimage
+from matplotlib.figure import Figure
 import io
 from PIL import Image
 import uuid
-import matplotlib
 
 
 def reduce_channels(X, channels_to_keep=13):
@@ -73,16 +81,17 @@ def save_image(mask, title):
     colors = [(1, 0, 0), (1, 1, 1), (0, 1, 0)]
     cmap = mcolors.LinearSegmentedColormap.from_list('custom_cmap', colors, N=256)
 
-    # Apply the colormap with normalization
-    plt.figure(figsize=(5, 5))
-    plt.imshow(mask, cmap=cmap, norm=norm)
-    plt.title(title)
-    plt.axis('off')
+    # Apply the colormap with normalization, on a figure of our own rather than pyplot's global one,
+    # as several pipelines may render at once in the threads of a worker
+    fig = Figure(figsize=(5, 5))
+    ax = fig.add_subplot()
+    ax.imshow(mask, cmap=cmap, norm=norm)
+    ax.set_title(title)
+    ax.axis('off')
 
     # Save the image
     buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100)
-    plt.close()
+    fig.savefig(buf, format='png', dpi=100)
     buf.seek(0)
     pil_img = Image.open(buf)
     np_img = np.array(pil_img)
@@ -112,9 +121,128 @@ def color_distribution(mask):
         'white': (white_pixels / total_pixels) * 100
     }
 
-def c_main(path, model):
+def image_info_from_stats(color_stats):
+    """
+    Format the color distribution of a mask as the image info reported to the user.
+
+    Parameters:
+    color_stats (dict): The color distribution, as returned by color_distribution().
+
+    Returns:
+    dict: The vegetation, weed and other percentages as strings.
+    """
+    return {
+        'Vegetation': f"{color_stats['green']:.2f}%",
+        'Weed': f"{color_stats['red']:.2f}%",
+        'Misc/Other': f"{color_stats['white']:.2f}%"
+    }
+
+def c_preview(indices, model):
+    """
+    Run a quick, approximate prediction on low-resolution vegetation indices.
+
+    Parameters:
+    indices (dict): Vegetation indices read at the model input size, see routes.process_indices.calculate_preview_indices().
+    model (keras.Model): The loaded segmentation model.
+
+    Returns:
+    tuple: The preview mask image and the approximate image info.
+    """
+    # Same channels and order as c_main after reduce_channels(), without the RGB channel
+    channels = [normalize_index(indices[index], nan_policy='fill') for index in process.SPECTRAL_INDICES[1:]]
+    X = np.stack(channels, axis=-1)[np.newaxis]
+
+    predicted_mask = model.predict(X, verbose=0)[0, :, :, 0]
+
+    color_stats = color_distribution(predicted_mask)
+    predicted_mask_pil, _ = save_image(predicted_mask, 'Preview Mask')
+    print(f"Preview color distribution: {color_stats}")
+
+    return predicted_mask_pil, image_info_from_stats(color_stats)
+
+def predict_mask(image, model, vegetation=None, valid=None, tile_cache=None):
+    """
+    Predict the mask of an index stack of any size by running the model tile by tile.
+    If screening masks are given, only tiles containing vegetation are considered, and if a tile cache is given,
+    only tiles without a cached prediction are sent to the model.
+
+    Parameters:
+    image (numpy.ndarray): The index stack with shape (height, width, num_channels).
+    model (keras.Model): The loaded segmentation model.
+    vegetation (numpy.ndarray): Optional boolean vegetation mask, see core.sparse.screening_masks().
+    valid (numpy.ndarray): Optional boolean valid-data mask; invalid pixels get the "other" value.
+    tile_cache (core.tile_cache.TileCache): Optional cache of per-tile predictions.
+
+    Returns:
+    numpy.ndarray: The predicted mask with shape (height, width).
+    dict: Inference statistics: number of tiles, tiles served from the cache, tiles predicted and share of compute saved.
+    """
+    tile_size = tuple(model.input_shape[1:3])
+    tiles, grid = tiling.split_tiles(image, tile_size)
+
+    if vegetation is None:
+        active = np.ones(len(tiles), dtype=bool)
+    else:
+        active = sparse.active_tiles(vegetation, tile_size)
+
+    predictions = np.full(tiles.shape[:3], sparse.OTHER_VALUE, dtype=np.float32)
+    todo = np.flatnonzero(active)
+    cached = 0
+
+    # Look up each active tile by content; only the misses go to the model
+    if tile_cache is not None and len(todo):
+        keys = {i: tile_cache.key(tiles[i]) for i in todo}
+        misses = []
+        for i in todo:
+            hit = tile_cache.get(keys[i])
+            if hit is not None and hit.shape == predictions.shape[1:]:
+                predictions[i] = hit
+            else:
+                misses.append(i)
+        cached = len(todo) - len(misses)
+        todo = np.array(misses, dtype=int)
+
+    if len(todo):
+        predictions[todo] = model.predict(tiles[todo])[..., 0]
+        if tile_cache is not None:
+            for i in todo:
+                tile_cache.put(keys[i], predictions[i])
+
+    mask = tiling.stitch_tiles(predictions, grid, image.shape[:2])
+    if valid is not None:
+        mask[~valid] = sparse.OTHER_VALUE
+
+    stats = {
+        'tiles': len(tiles),
+        'tiles_cached': cached,
+        'tiles_predicted': len(todo),
+        'compute_saved': f"{100 * (1 - len(todo) / len(tiles)):.2f}%"
+    }
+    print(f"Inference statistics: {stats}")
+    return mask, stats
+
+def c_main(path, model, export_formats=(), export_folder='./tmp/export', export_dtype='int8', sparse_inference=False,
+           tile_cache=None, nan_policy='mask'):
+    """
+    Run the prediction pipeline on a directory of index .tif files.
+
+    Parameters:
+    path (str): The directory containing the index .tif files.
+    model (keras.Model): The loaded segmentation model.
+    export_formats (iterable): Export formats for the mask, any of core.export.EXPORT_FORMATS. Default is none.
+    export_folder (str): Path to the folder where the exports will be written.
+    export_dtype (str): Quantization of the exported GeoTIFF, 'int8' scores or a 'uint8' class map.
+    sparse_inference (bool): If True, skip tiles without vegetation and nodata pixels (see core.sparse).
+    tile_cache (core.tile_cache.TileCache): Optional cache of per-tile predictions.
+    nan_policy (str): 'mask' to predict "other" wherever an index is missing (NaN or infinite), or 'fill' to run
+                      the model on those pixels with the fill value (see core.normalize).
+
+    Returns:
+    tuple: The prediction id, input images, predicted mask image, image info, spectrum names,
+           a dictionary mapping each export format to its file name inside export_folder, and inference statistics.
+    """
     # Preprocess the data and get the input images and original RGB images
-    X, original_rgb_images, spectrum_names = process.pre_process(path)
+    X, original_rgb_images, spectrum_names = process.pre_process(path, nan_policy)
     print(f'Number of images: {X.shape[0]}')
 
     if X.size == 0:
@@ -125,18 +253,26 @@ def c_main(path, model):
         X = reduce_channels(X, channels_to_keep=13)
         spectrum_names = spectrum_names[:13]  # Adjust the spectrum names if necessary
 
-    matplotlib.use('Agg')
+    # Screen out bare soil and nodata with the unscaled NDVI raster
+    vegetation, valid = None, None
+    if sparse_inference:
+        vegetation, valid = sparse.screening_masks(process.load_index(path, 'NDVI'))
+
+    # Mask the pixels with a missing index; the placeholder given to the model there does not affect the output
+    if nan_policy == 'mask':
+        missing = np.isnan(X[0]).any(axis=-1)
+        if missing.any():
+            print(f"Masking {np.count_nonzero(missing)} pixels with missing index values")
+            np.nan_to_num(X, copy=False, nan=NAN_FILL_VALUE)
+            valid = ~missing if valid is None else valid & ~missing
 
     print("Predicting on validation set")
-    y_pred = model.predict(X)
+    predicted_mask, inference_stats = predict_mask(X[0], model, vegetation, valid, tile_cache)
 
     # Save the original RGB image
     original_rgb_image = original_rgb_images[0]
     input_images = [save_image(original_rgb_image, 'Original RGB')[0]]
 
-    # Get the predicted mask
-    predicted_mask = y_pred[0, :, :, 0]  # Take the first channel
-
     # Calculate color distribution using the original predicted mask
     color_stats = color_distribution(predicted_mask)
 
@@ -144,7 +280,7 @@ def c_main(path, model):
     predicted_mask_pil, predicted_mask_np = save_image(predicted_mask, 'Predicted Mask')
 
     # Save the original mask and colorized mask for visual inspection
-    plt.imsave('predicted_mask_with_true_range.png', predicted_mask_np)
+    mimage.imsave('predicted_mask_with_true_range.png', predicted_mask_np)
 
     print(f"Predicted mask shape: {predicted_mask.shape}")
     print(f"Predicted mask min: {predicted_mask.min()}, max: {predicted_mask.max()}")
@@ -154,12 +290,13 @@ def c_main(path, model):
     pid = str(uuid.uuid4())
 
     # Image info
-    image_info = {
-        'Vegetation': f"{color_stats['green']:.2f}%",
-        'Weed': f"{color_stats['red']:.2f}%",
-        'Misc/Other': f"{color_stats['white']:.2f}%"
-    }
+    image_info = image_info_from_stats(color_stats)
 
     print(f"Original RGB image shape: {original_rgb_images[0].shape}, dtype: {original_rgb_images[0].dtype}")
 
-    return pid, input_images, predicted_mask_pil, image_info, ['RGB']
+    # Export the raw mask for downstream machinery if requested
+    exports = {}
+    if export_formats:
+        exports = export.export_mask(predicted_mask, path, export_folder, pid, export_formats, export_dtype)
+
+    return pid, input_images, predicted_mask_pil, image_info, ['RGB'], exports, inference_stats
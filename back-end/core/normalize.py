@@ -0,0 +1,155 @@
+# This script normalizes index rasters for the model with as few passes over the pixels as possible.
+# The main features include:
+# 1. Computing the minimum and maximum of the finite pixels in a single pass, block by block, so that each block
+#    is checked for NaN/inf, cleaned and reduced while it is still in the CPU cache.
+# 2. Reading those statistics from the GDAL statistics tags written with the index rasters instead, when present,
+#    which leaves a single pass for the whole normalization.
+# 3. Min-max scaling in place, without allocating temporaries the size of the image.
+# 4. Configurable handling of missing (NaN or infinite) pixels: 'mask' keeps them as NaN for the caller to mask,
+#    'fill' replaces them with the scaled position of a raw index value of 0, i.e. no spectral contrast, which
+#    depends on the range of each index (a fixed 0 after scaling would read as the index minimum instead).
+
+import numpy as np
+
+# Elements processed per block; small enough for a block and its temporaries to stay in the CPU cache
+BLOCK_SIZE = 1 << 16
+
+NAN_POLICIES = ('mask', 'fill')
+
+# Placeholder given to missing pixels that are masked out of the prediction anyway
+NAN_FILL_VALUE = 0.0
+
+
+def _blocks(image):
+    flat = image.reshape(-1)
+    for start in range(0, flat.size, BLOCK_SIZE):
+        yield flat[start:start + BLOCK_SIZE]
+
+def _clean_block(block):
+    """
+    Set the non-finite values of a block to NaN in place.
+
+    Returns:
+    int: The number of non-finite values.
+    """
+    bad = ~np.isfinite(block)
+    missing = np.count_nonzero(bad)
+    if missing:
+        block[bad] = np.nan
+    return missing
+
+def finite_min_max(image):
+    """
+    Compute the minimum and maximum of the finite pixels of an image in one pass, setting infinite values to NaN
+    in place along the way.
+
+    Parameters:
+    image (numpy.ndarray): A C-contiguous floating-point image.
+
+    Returns:
+    float: The minimum, or None if no pixel is finite.
+    float: The maximum, or None if no pixel is finite.
+    int: The number of missing (NaN or infinite) pixels.
+    """
+    min_val, max_val, missing = np.inf, -np.inf, 0
+    for block in _blocks(image):
+        block_missing = _clean_block(block)
+        missing += block_missing
+        if block_missing < block.size:
+            min_val = min(min_val, np.fmin.reduce(block))  # fmin/fmax skip NaN
+            max_val = max(max_val, np.fmax.reduce(block))
+
+    if missing == image.size:
+        return None, None, missing
+    return float(min_val), float(max_val), missing
+
+def statistics_tags(min_val, max_val, missing, size):
+    """
+    Build the GDAL statistics tags of a band, for rasterio's update_tags().
+
+    Parameters:
+    min_val, max_val (float): The minimum and maximum of the finite pixels.
+    missing (int): The number of missing pixels.
+    size (int): The number of pixels.
+
+    Returns:
+    dict: The STATISTICS_* tags.
+    """
+    # Plain decimal strings: repr() of a NumPy 2 scalar reads 'np.float64(...)', which float() cannot parse back
+    return {
+        'STATISTICS_MINIMUM': f'{float(min_val):.17g}',
+        'STATISTICS_MAXIMUM': f'{float(max_val):.17g}',
+        'STATISTICS_VALID_PERCENT': f'{100 * (1 - int(missing) / int(size)):.17g}',
+    }
+
+def read_statistics(src, bands=(1,)):
+    """
+    Read the exact GDAL statistics of the given bands of a raster, combined over the bands.
+
+    Parameters:
+    src (rasterio.DatasetReader): The open raster.
+    bands (tuple): The band numbers. Default is the first band.
+
+    Returns:
+    dict: 'min', 'max' and 'complete' (True if every pixel is valid), or None if a band lacks exact statistics.
+    """
+    mins, maxs, complete = [], [], True
+    for band in bands:
+        tags = src.tags(band)
+        if 'STATISTICS_MINIMUM' not in tags or 'STATISTICS_MAXIMUM' not in tags:
+            return None
+        if tags.get('STATISTICS_APPROXIMATE', 'NO').upper() == 'YES':
+            return None  # Computed on overviews or a subsample; the true range may be wider
+        try:
+            mins.append(float(tags['STATISTICS_MINIMUM']))
+            maxs.append(float(tags['STATISTICS_MAXIMUM']))
+            complete = complete and float(tags.get('STATISTICS_VALID_PERCENT', 0)) == 100
+        except ValueError:
+            return None
+    return {'min': min(mins), 'max': max(maxs), 'complete': complete}
+
+def normalize_index(image, stats=None, nan_policy='mask', fill_value=None, always_scale=False):
+    """
+    Min-max scale an index image to [0, 1] in place if its values fall outside that range, and handle its
+    missing pixels. Without precomputed statistics this takes two passes over the pixels, otherwise one.
+
+    Parameters:
+    image (numpy.ndarray): The index image; converted to contiguous float32 first if it is not already.
+    stats (dict): Precomputed statistics, see read_statistics(). Computed if not given.
+    nan_policy (str): 'mask' to leave missing pixels as NaN, or 'fill' to set them to fill_value.
+    fill_value (float): Value of missing pixels after scaling with the 'fill' policy. Default is the scaled value of
+                        a raw 0, clipped to [0, 1].
+    always_scale (bool): If True, scale even if the values already lie within [0, 1] (e.g. RGB images).
+
+    Returns:
+    numpy.ndarray: The normalized float32 image.
+    """
+    if nan_policy not in NAN_POLICIES:
+        raise ValueError(f"Unsupported NaN policy {nan_policy}; choose from {', '.join(NAN_POLICIES)}")
+
+    image = np.ascontiguousarray(image, dtype=np.float32)
+    if stats is None:
+        min_val, max_val, missing = finite_min_max(image)
+        clean = False  # Already cleaned by finite_min_max()
+    else:
+        min_val, max_val, missing = stats['min'], stats['max'], 0 if stats['complete'] else None
+        clean = not stats['complete']
+
+    scale = min_val is not None and (always_scale or min_val < 0 or max_val > 1)
+    fill = nan_policy == 'fill' and missing != 0
+    if not (scale or fill or clean):
+        return image
+
+    factor = np.float32(1 / (max_val - min_val)) if scale and max_val > min_val else np.float32(0)
+    if fill and fill_value is None:
+        fill_value = min(max(-min_val * float(factor), 0.0), 1.0) if scale else 0.0
+    for block in _blocks(image):
+        if clean:
+            _clean_block(block)
+        if scale:
+            block -= np.float32(min_val)
+            block *= factor
+        if fill:
+            np.nan_to_num(block, copy=False, nan=fill_value)
+
+    return image
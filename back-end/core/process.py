@@ -1,10 +1,11 @@
 # This script is part of the DPIRD Intellicrop project, designed to process satellite or aerial imagery data.
 # It primarily focuses on loading and processing multi-spectral images stored in .tif format.
 # The main steps include:
-# 1. Configuring GPU settings for TensorFlow to handle large datasets efficiently.
+# 1. Configuring GPU settings for TensorFlow to handle large datasets efficiently (once per process, see configure_gpus).
 # 2. Loading and pre-processing image files, with support for both RGB and single-channel spectral images.
-# 3. Stacking the spectral indices in the correct order and scaling the pixel values as needed.
-# 4. Handling missing data by skipping directories that do not contain all the required spectral indices.
+# 3. Stacking the spectral indices in the correct order and scaling the pixel values as needed (see core.normalize).
+# 4. Handling missing data by skipping directories that do not contain all the required spectral indices,
+#    and missing pixels by masking or filling them.
 # The processed data is prepared for further analysis or model training in the context of agricultural monitoring.
 
 import os
@@ -12,29 +13,38 @@ import numpy as np
 import rasterio
 import tensorflow as tf
 import zipfile
+from core.normalize import normalize_index, read_statistics
 
 # Define the spectral indices that the model expects
 SPECTRAL_INDICES = ['RGB', 'CI', 'EVI', 'ExG', 'ExR', 'GNDVI', 'MCARI', 'MGRVI', 'MSAVI', 'NDVI', 'OSAVI', 'PRI', 'SAVI', 'TVI']
 
-# GPU configuration (unchanged)
-gpus = tf.config.experimental.list_physical_devices('GPU')
-if gpus:
-    try:
-        for gpu in gpus:
-            tf.config.experimental.set_memory_growth(gpu, True)  # Enable dynamic memory allocation for GPUs
-        print(f"Available GPUs: {gpus}")
-    except RuntimeError as e:
-        print(e)
-else:
-    print("No GPUs available. Check your CUDA and cuDNN installation.")  # Display if no GPUs are detected
-
-def load_tif(file_path, is_rgb=False):
+def configure_gpus():
     """
-    Load a .tif file and return the image data.
+    Enable dynamic memory allocation on the available GPUs.
+    This initializes the CUDA driver, so with gunicorn it must run in each worker after the fork, never in the master.
+    """
+    gpus = tf.config.experimental.list_physical_devices('GPU')
+    if gpus:
+        try:
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, True)  # Enable dynamic memory allocation for GPUs
+            print(f"Available GPUs: {gpus}")
+        except RuntimeError as e:
+            print(e)
+    else:
+        print("No GPUs available. Check your CUDA and cuDNN installation.")  # Display if no GPUs are detected
+
+def load_tif(file_path, is_rgb=False, nan_policy='mask', fill_value=None):
+    """
+    Load a .tif file and return the normalized image data (see core.normalize).
+    The range used for scaling comes from the file's statistics tags when present, so that the image is only
+    traversed once; otherwise it is computed in a single pass.
 
     Parameters:
     file_path (str): The path to the .tif file.
     is_rgb (bool): If True, load the image as an RGB image with three channels. Default is False.
+    nan_policy (str): 'mask' to keep missing (NaN or infinite) pixels as NaN, or 'fill' to set them to fill_value.
+    fill_value (float): Value of missing pixels with the 'fill' policy. Default is the normalized value of a raw 0.
 
     Returns:
     numpy.ndarray: The loaded image as a numpy array, with scaling if necessary.
@@ -42,43 +52,47 @@ def load_tif(file_path, is_rgb=False):
     print(f"Loading TIF file from {file_path}")
     with rasterio.open(file_path) as src:
         if is_rgb:
-            # Load all three channels for an RGB image
-            image = np.dstack([src.read(i) for i in range(1, 4)]).astype(np.float32)
+            # Load all three channels for an RGB image, channels last
+            image = np.moveaxis(src.read((1, 2, 3), out_dtype='float32'), 0, -1)
+            stats = read_statistics(src, (1, 2, 3))
         else:
             # Load only the first channel for non-RGB images
-            image = src.read(1).astype(np.float32)
-
-    # Check for NaN values in the image data
-    if np.isnan(image).any():
-        print(f"NaN detected in file {file_path}")
-        return None
-
-    # Check if scaling is necessary for the image values
-    min_val = np.min(image)
-    max_val = np.max(image)
-
-    if is_rgb:
-        print(f"Loading RGB image from {file_path}")
-        # Normalize RGB to [0, 1] range
-        image = (image - min_val) / (max_val - min_val)
-        return image
-
-    if min_val < 0 or max_val > 1:
-        print(f"Scaling applied to {file_path}")
-        # Apply min-max scaling for non-RGB images
-        image = (image - min_val) / (max_val - min_val)
-    else:
-        print(f"No scaling needed for {file_path}")
-        print(f"Data range: [{min_val}, {max_val}]")
+            image = src.read(1, out_dtype='float32')
+            stats = read_statistics(src)
+
+    print(f"{'Precomputed' if stats else 'No'} statistics for {file_path}")
+    # RGB images are always normalized to the [0, 1] range
+    return normalize_index(image, stats, nan_policy, fill_value, always_scale=is_rgb)
+
+def load_index(base_path, index):
+    """
+    Load a single spectral index from the given directory without any scaling.
+
+    Parameters:
+    base_path (str): The path to the directory containing the .tif files.
+    index (str): The spectral index to load, e.g. 'NDVI'.
+
+    Returns:
+    numpy.ndarray: The raw index values, with the raster's nodata pixels set to NaN.
+    """
+    matching_files = sorted(f for f in os.listdir(base_path) if f.startswith(f'{index}_') and f.endswith('.tif'))
+    if not matching_files:
+        raise ValueError(f"Missing file for index {index} in directory {base_path}")
+
+    with rasterio.open(os.path.join(base_path, matching_files[0])) as src:
+        image = src.read(1).astype(np.float32)
+        if src.nodata is not None:
+            image[image == src.nodata] = np.nan
 
     return image
 
-def create_dataset(base_path):
+def create_dataset(base_path, nan_policy='mask'):
     """
     Create a dataset by loading and stacking images from the given directory.
 
     Parameters:
     base_path (str): The path to the directory containing the .tif files.
+    nan_policy (str): Handling of missing pixels in the index images, see load_tif().
 
     Returns:
     numpy.ndarray: A stacked numpy array of image data.
@@ -101,8 +115,8 @@ def create_dataset(base_path):
         if matching_files:
             file_path = os.path.join(base_path, matching_files[0])
             print(f"Found file for {index}: {file_path}")
-            # Set is_rgb=True for RGB images
-            data = load_tif(file_path, is_rgb=(index == 'RGB'))
+            # Set is_rgb=True for RGB images, whose missing pixels are always filled for display
+            data = load_tif(file_path, is_rgb=(index == 'RGB'), nan_policy='fill' if index == 'RGB' else nan_policy)
 
             # For RGB images, use the first channel only
             if index == 'RGB':
@@ -134,12 +148,13 @@ def create_dataset(base_path):
 
     return np.array(inputs), np.array(original_rgb_images)
 
-def pre_process(data_path):
+def pre_process(data_path, nan_policy='mask'):
     """
     Pre-process the images by loading them from the given data path.
 
     Parameters:
     data_path (str): The path to the directory containing the .tif files.
+    nan_policy (str): Handling of missing pixels in the index images, see load_tif().
 
     Returns:
     numpy.ndarray: The pre-processed image data.
@@ -147,5 +162,5 @@ def pre_process(data_path):
     list: The list of spectral indices.
     """
     print("data_path", data_path)
-    X, original_rgb_images = create_dataset(data_path)
+    X, original_rgb_images = create_dataset(data_path, nan_policy)
     return X, original_rgb_images, SPECTRAL_INDICES
@@ -0,0 +1,236 @@
+# This script spreads tile inference over a pool of inference worker nodes (see inference_worker.py).
+# The coordinator, i.e. the node handling the upload, keeps splitting, screening, caching and stitching tiles as usual;
+# only the model call is replaced:
+# 1. Tiles are grouped into batches and sent over HTTP, as .npy payloads, to the workers in round-robin order.
+# 2. A failed batch is retried on a different worker, up to a fixed number of attempts.
+# 3. A batch that is still outstanding after a delay (a straggler) is duplicated on another worker,
+#    and whichever copy answers first is used.
+# 4. The results are put back in the order of the input tiles.
+
+import io
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import requests
+
+
+def encode_array(array):
+    """
+    Serialise an array as .npy bytes.
+
+    Parameters:
+    array (numpy.ndarray): The array.
+
+    Returns:
+    bytes: The .npy payload.
+    """
+    buf = io.BytesIO()
+    np.save(buf, array, allow_pickle=False)
+    return buf.getvalue()
+
+def decode_array(payload):
+    """
+    Deserialise .npy bytes produced by encode_array().
+
+    Parameters:
+    payload (bytes): The .npy payload.
+
+    Returns:
+    numpy.ndarray: The array.
+    """
+    return np.load(io.BytesIO(payload), allow_pickle=False)
+
+class RemotePredictor:
+    """
+    Drop-in replacement for a Keras model in the prediction pipeline that runs `predict` on remote inference workers.
+    """
+
+    def __init__(self, worker_urls, batch_size=4, timeout=120, retries=2, hedge_after=10):
+        """
+        Parameters:
+        worker_urls (list): Base URLs of the inference workers, e.g. ['http://127.0.0.1:5101'].
+        batch_size (int): Number of tiles sent in one request. Default is 4.
+        timeout (float): Seconds before a request is abandoned. Default is 120.
+        retries (int): Extra attempts for a batch after a failed request. Default is 2.
+        hedge_after (float): Seconds after which an outstanding batch is duplicated on another worker. Default is 10.
+        """
+        if not worker_urls:
+            raise ValueError("At least one inference worker URL is required")
+        self.worker_urls = [url.rstrip('/') for url in worker_urls]
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge_after = hedge_after
+        self._round_robin = itertools.cycle(range(len(self.worker_urls)))
+        self._lock = threading.Lock()
+        self._info = None
+        self._local = threading.local()
+
+    def _session(self):
+        # requests.Session is not thread-safe; keep one per thread for connection reuse
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def info(self):
+        """
+        Fetch the model description from the first worker that answers.
+
+        Returns:
+        dict: The worker's 'input_shape' and 'model_version'.
+        """
+        if self._info is None:
+            errors = []
+            for url in self.worker_urls:
+                try:
+                    response = self._session().get(f'{url}/info', timeout=self.timeout)
+                    response.raise_for_status()
+                    self._info = response.json()
+                    break
+                except (requests.RequestException, ValueError) as e:
+                    errors.append(f'{url}: {e}')
+            else:
+                raise RuntimeError(f"No inference worker reachable: {errors}")
+        return self._info
+
+    @property
+    def input_shape(self):
+        return tuple(self.info()['input_shape'])
+
+    def warm_up(self, batch_sizes=None):
+        """
+        Prepare a freshly forked worker process: drop connections inherited from the parent and check that the
+        inference workers answer.
+
+        Parameters:
+        batch_sizes (iterable): Accepted for compatibility with CompiledPredictor.warm_up() and ignored.
+        """
+        self._local = threading.local()
+        self._info = None
+        print(f"Inference workers serve input shape {self.input_shape}")
+
+    def _pick_worker(self, exclude=(), avoid=()):
+        """
+        Choose the next worker in round-robin order, avoiding the given ones if possible.
+
+        Parameters:
+        exclude (iterable): Worker indices already tried for this batch, skipped while untried workers remain.
+        avoid (iterable): Worker indices that failed or are still running this batch, only chosen if no other
+                          worker is left.
+
+        Returns:
+        int: The index of the chosen worker.
+        """
+        with self._lock:
+            for skip in (set(exclude) | set(avoid), set(avoid)):
+                for _ in range(len(self.worker_urls)):
+                    worker = next(self._round_robin)
+                    if worker not in skip:
+                        return worker
+            return next(self._round_robin)
+
+    def _send(self, worker, payload):
+        """
+        Send one batch to a worker.
+
+        Parameters:
+        worker (int): The index of the worker.
+        payload (bytes): The batch as .npy bytes.
+
+        Returns:
+        numpy.ndarray: The predictions for the batch.
+        """
+        response = self._session().post(f'{self.worker_urls[worker]}/predict', data=payload, timeout=self.timeout,
+                                        headers={'Content-Type': 'application/octet-stream'})
+        response.raise_for_status()
+        return decode_array(response.content)
+
+    def predict(self, X, verbose=0, **kwargs):
+        """
+        Run the model on a batch of tiles using the remote workers, like keras.Model.predict.
+
+        Parameters:
+        X (numpy.ndarray): The input tiles with shape (num_tiles, height, width, num_channels).
+        verbose (int): Accepted for compatibility with keras.Model.predict and ignored.
+
+        Returns:
+        numpy.ndarray: The predictions, in the order of the input tiles.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        if len(X) == 0:
+            return np.zeros(X.shape[:3] + (1,), dtype=np.float32)
+
+        payloads = [encode_array(X[i:i + self.batch_size]) for i in range(0, len(X), self.batch_size)]
+        results = [None] * len(payloads)
+        tried = [set() for _ in payloads]     # Workers each batch has been sent to
+        failed = [set() for _ in payloads]    # Workers each batch has failed on
+        failures = [0] * len(payloads)
+        hedged = [False] * len(payloads)
+        started = [None] * len(payloads)     # Time each batch was first sent, excluding time queued in the pool
+        pending = {}                          # Future -> batch index
+        assigned = {}                         # Future -> worker index
+
+        pool = ThreadPoolExecutor(max_workers=2 * len(self.worker_urls))
+
+        def run(index, worker):
+            started[index] = started[index] or time.monotonic()
+            return self._send(worker, payloads[index])
+
+        def submit(index):
+            running = {assigned[future] for future, i in pending.items() if i == index}
+            worker = self._pick_worker(tried[index], failed[index] | running)
+            tried[index].add(worker)
+            future = pool.submit(run, index, worker)
+            pending[future] = index
+            assigned[future] = worker
+
+        try:
+            for index in range(len(payloads)):
+                submit(index)
+
+            while pending:
+                done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    index = pending.pop(future)
+                    worker = assigned.pop(future)
+                    if results[index] is not None:
+                        continue  # The other copy of a hedged batch already answered
+                    try:
+                        results[index] = future.result()
+                    except (requests.RequestException, ValueError) as e:
+                        failures[index] += 1
+                        failed[index].add(worker)
+                        # The remaining or resubmitted copy may straggle too, so it may be hedged again
+                        hedged[index] = False
+                        if index in pending.values():
+                            continue  # A hedged copy is still running
+                        if failures[index] > self.retries:
+                            raise RuntimeError(f"Batch {index} failed on {failures[index]} attempts: {e}")
+                        print(f"Batch {index} failed ({e}), retrying on another worker")
+                        started[index] = None
+                        submit(index)
+
+                # Drop duplicates of batches that are already answered
+                for future, index in list(pending.items()):
+                    if results[index] is not None:
+                        future.cancel()
+                        del pending[future]
+                        del assigned[future]
+
+                # Stragglers: duplicate batches outstanding for longer than hedge_after on another worker,
+                # including batches whose hedged copy just failed
+                now = time.monotonic()
+                for index in set(pending.values()):
+                    if hedged[index] or len(self.worker_urls) < 2 or started[index] is None:
+                        continue
+                    if now - started[index] > self.hedge_after:
+                        hedged[index] = True
+                        print(f"Batch {index} is straggling, hedging on another worker")
+                        submit(index)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        return np.concatenate(results)
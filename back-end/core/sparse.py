@@ -0,0 +1,51 @@
+# This script screens index tiles so that the model only runs where there is something to classify.
+# Large parts of a paddock are bare soil, tracks or nodata borders. Before inference:
+# 1. A vegetation mask is computed from the raw NDVI raster with a cheap threshold. NDVI is a band ratio, so the
+#    threshold holds whatever the scale of the bands (reflectance or integer digital numbers), unlike ExG.
+# 2. A nodata mask marks pixels where the indices are undefined (e.g. zero bands at the image borders).
+# 3. Tiles with too little vegetation are skipped; their pixels, and all nodata pixels, get the constant "other" value.
+
+import numpy as np
+from core import tiling
+
+# A pixel counts as vegetation if its NDVI exceeds this threshold
+NDVI_THRESHOLD = 0.2
+
+# Tiles with a smaller share of vegetation pixels are not sent to the model
+MIN_VEGETATION_FRACTION = 0.001
+
+# Mask value for skipped and nodata pixels; 0 falls in the white "Misc/Other" band of core.main.color_distribution
+OTHER_VALUE = 0.0
+
+
+def screening_masks(ndvi, ndvi_threshold=NDVI_THRESHOLD):
+    """
+    Compute the vegetation and valid-data masks used to screen tiles.
+
+    Parameters:
+    ndvi (numpy.ndarray): The unscaled NDVI raster.
+    ndvi_threshold (float): NDVI above which a pixel counts as vegetation.
+
+    Returns:
+    numpy.ndarray: Boolean mask of vegetation pixels.
+    numpy.ndarray: Boolean mask of pixels with valid data.
+    """
+    valid = np.isfinite(ndvi)
+    with np.errstate(invalid='ignore'):
+        vegetation = valid & (ndvi > ndvi_threshold)
+    return vegetation, valid
+
+def active_tiles(vegetation, tile_size, min_fraction=MIN_VEGETATION_FRACTION):
+    """
+    Select the tiles that contain enough vegetation to be worth running the model on.
+
+    Parameters:
+    vegetation (numpy.ndarray): Boolean mask of vegetation pixels, as returned by screening_masks().
+    tile_size (tuple): The (height, width) of a tile.
+    min_fraction (float): Minimum share of vegetation pixels in a tile. Default is MIN_VEGETATION_FRACTION.
+
+    Returns:
+    numpy.ndarray: Boolean array with one entry per tile, in the order of tiling.split_tiles().
+    """
+    tiles, _ = tiling.split_tiles(vegetation, tile_size)
+    return tiles.mean(axis=(1, 2)) >= min_fraction
@@ -0,0 +1,145 @@
+# This script caches model predictions per tile, so that a field submitted again (e.g. retried after an error, or
+# re-run for other export formats) skips inference. The main features include:
+# 1. Content addressing: a tile's key is a hash of its 13-channel index data together with the model version,
+#    so a changed tile or a new model never returns a stale prediction.
+# 2. A bounded on-disk store, shared by all worker processes, with least-recently-used eviction based on file
+#    modification times, which are refreshed on every hit.
+# 3. Atomic writes (write then rename), so concurrent workers never read a half-written entry.
+# The keys hash the tiles the model sees: index data min-max scaled over the whole upload and tiled from its origin.
+# A re-flown paddock or a different crop of the same field therefore scales and aligns differently and misses the
+# cache; only an identical resubmission hits it.
+
+import hashlib
+import os
+import threading
+import uuid
+import numpy as np
+
+
+def model_version(model_path):
+    """
+    Compute a version identifier for a model file from its contents.
+
+    Parameters:
+    model_path (str): Path to the model file.
+
+    Returns:
+    str: The first 16 hex digits of the file's SHA-256.
+    """
+    hasher = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()[:16]
+
+class TileCache:
+    """
+    Bounded, content-addressed on-disk cache of per-tile model predictions.
+    """
+
+    def __init__(self, folder, max_bytes, version):
+        """
+        Parameters:
+        folder (str): Directory holding the cached predictions.
+        max_bytes (int): Size budget of the directory; the least recently used entries are evicted beyond it.
+        version (str): Model version mixed into every key, see model_version().
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.version = version.encode()
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._bytes = self._scan()[1]
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], f'{key}.npy')
+
+    def _scan(self):
+        """
+        List the cached entries.
+
+        Returns:
+        list: (modification time, size, path) for every entry.
+        int: The total size of the entries in bytes.
+        """
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for file in files:
+                if file.endswith('.npy'):
+                    try:
+                        stat = os.stat(os.path.join(root, file))
+                    except FileNotFoundError:
+                        continue  # Evicted by another worker meanwhile
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+        return entries, sum(size for _, size, _ in entries)
+
+    def key(self, tile):
+        """
+        Compute the cache key of an input tile, as normalized for the model; see the note at the top of the module.
+
+        Parameters:
+        tile (numpy.ndarray): The input tile with shape (height, width, num_channels).
+
+        Returns:
+        str: The hex key.
+        """
+        tile = np.ascontiguousarray(tile, dtype=np.float32)
+        hasher = hashlib.blake2b(self.version, digest_size=20)
+        hasher.update(str(tile.shape).encode())
+        hasher.update(tile.data)
+        return hasher.hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached prediction for a key and mark it as recently used.
+
+        Parameters:
+        key (str): The key, as returned by key().
+
+        Returns:
+        numpy.ndarray: The cached prediction, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            prediction = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return prediction
+
+    def put(self, key, prediction):
+        """
+        Store a prediction, evicting the least recently used entries if the size budget is exceeded.
+
+        Parameters:
+        key (str): The key, as returned by key().
+        prediction (numpy.ndarray): The predicted tile.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, prediction)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._bytes += os.path.getsize(path)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Delete the least recently used entries until the cache is at 90% of its budget.
+        The on-disk total is rescanned first, as other worker processes write to the same folder.
+        """
+        entries, total = self._scan()
+        for _, size, path in sorted(entries):
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._bytes = total
+        print(f"Tile cache evicted down to {total / 1024 ** 2:.0f} MB")
@@ -0,0 +1,62 @@
+# This script splits index stacks into model-sized tiles and stitches the predicted tiles back together.
+# The segmentation model takes a fixed input size, so fields of any size are processed as a grid of tiles:
+# 1. The image is zero-padded to a whole number of tiles and reshaped into a batch of tiles, in row-major order.
+# 2. After prediction the tiles are reassembled in the same order and the padding is cropped off.
+
+import math
+import numpy as np
+
+
+def tile_grid(shape, tile_size):
+    """
+    Compute the number of tile rows and columns needed to cover an image.
+
+    Parameters:
+    shape (tuple): The (height, width) of the image.
+    tile_size (tuple): The (height, width) of a tile.
+
+    Returns:
+    tuple: The number of tile rows and columns.
+    """
+    return math.ceil(shape[0] / tile_size[0]), math.ceil(shape[1] / tile_size[1])
+
+def split_tiles(image, tile_size):
+    """
+    Split an image into a batch of tiles, padding the bottom and right edges with zeros.
+
+    Parameters:
+    image (numpy.ndarray): The image with shape (height, width) or (height, width, num_channels).
+    tile_size (tuple): The (height, width) of a tile.
+
+    Returns:
+    numpy.ndarray: The tiles with shape (num_tiles, tile_height, tile_width[, num_channels]), in row-major order.
+    tuple: The number of tile rows and columns.
+    """
+    rows, cols = tile_grid(image.shape[:2], tile_size)
+    th, tw = tile_size
+
+    padding = [(0, rows * th - image.shape[0]), (0, cols * tw - image.shape[1])] + [(0, 0)] * (image.ndim - 2)
+    if any(p[1] for p in padding):
+        image = np.pad(image, padding)
+
+    tiles = image.reshape((rows, th, cols, tw) + image.shape[2:]).swapaxes(1, 2)
+    return tiles.reshape((rows * cols, th, tw) + image.shape[2:]), (rows, cols)
+
+def stitch_tiles(tiles, grid, shape):
+    """
+    Reassemble tiles produced by split_tiles() into an image and crop off the padding.
+
+    Parameters:
+    tiles (numpy.ndarray): The tiles with shape (num_tiles, tile_height, tile_width[, num_channels]), in row-major order.
+    grid (tuple): The number of tile rows and columns.
+    shape (tuple): The (height, width) of the original image.
+
+    Returns:
+    numpy.ndarray: The stitched image with shape (height, width[, num_channels]).
+    """
+    rows, cols = grid
+    th, tw = tiles.shape[1:3]
+
+    image = tiles.reshape((rows, cols, th, tw) + tiles.shape[3:]).swapaxes(1, 2)
+    image = image.reshape((rows * th, cols * tw) + tiles.shape[3:])
+    return image[:shape[0], :shape[1]]
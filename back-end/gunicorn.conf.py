@@ -0,0 +1,27 @@
+# Gunicorn settings for serving the DPIRD Intellicrop back-end in production.
+# The app is built once in the master, and each forked worker then loads the model itself: the TensorFlow runtime
+# (thread pools, CUDA context) does not survive fork(), so the master never creates it.
+# The number of pipelines running at once is bounded separately by MAX_CONCURRENT_PIPELINES (see app.py).
+
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5003')
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))  # Lets cheap requests (status, downloads) through while pipelines run
+worker_class = 'gthread'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))  # A full pipeline on a large field can take minutes
+graceful_timeout = 60
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 200))  # Recycle workers to bound memory growth
+max_requests_jitter = 20
+
+
+def post_worker_init(worker):
+    """
+    Load the model and run the inference graph once in each freshly forked worker, before it accepts requests.
+
+    Parameters:
+    worker (gunicorn Worker): The initialised worker; `worker.wsgi` is the Flask app.
+    """
+    from app import load_app_model
+    load_app_model(worker.wsgi)
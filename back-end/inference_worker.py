@@ -0,0 +1,80 @@
+# This script runs an inference worker node for the DPIRD Intellicrop back-end.
+# A worker loads model1.h5 once and serves tile predictions over HTTP to the upload node (see core.remote):
+# 1. GET /info describes the model: its input shape and version.
+# 2. POST /predict takes a batch of index tiles as an .npy body and returns the predictions as .npy.
+#
+# To spread inference over several workers on one machine, start for example:
+#     python inference_worker.py --port 5101
+#     python inference_worker.py --port 5102
+# and run the back-end with INFERENCE_WORKERS=http://127.0.0.1:5101,http://127.0.0.1:5102
+
+import argparse
+from flask import Flask, jsonify, request, make_response
+from tensorflow.keras.models import load_model
+import tensorflow as tf
+from custom_layers import custom_objects
+from core.inference import CompiledPredictor
+from core.remote import encode_array, decode_array
+from core.tile_cache import model_version
+
+MODEL_PATH = 'model1.h5'
+
+
+def create_worker_app(model_path=MODEL_PATH, jit_compile=False):
+    """
+    Creates the worker Flask application and loads the model, warmed up, onto it.
+
+    Parameters:
+    model_path (str): Path to the Keras model. Default is model1.h5.
+    jit_compile (bool): If True, compile the inference graphs with XLA. Default is False.
+
+    Returns:
+    Flask app object: The worker app.
+    """
+    app = Flask(__name__)
+
+    custom_objects['mse'] = tf.keras.losses.mse  # Adding custom loss function
+    app.model = CompiledPredictor(load_model(model_path, custom_objects=custom_objects), jit_compile=jit_compile)
+    app.model.warm_up()
+    app.model_version = model_version(model_path)
+
+    @app.route('/info', methods=['GET'])
+    def info():
+        """
+        Describes the model served by this worker.
+
+        Returns:
+        JSON response: The model input shape (batch dimension as null) and version.
+        """
+        return jsonify({'input_shape': list(app.model.input_shape), 'model_version': app.model_version})
+
+    @app.route('/predict', methods=['POST'])
+    def predict():
+        """
+        Predicts a batch of tiles.
+
+        Returns:
+        Response: The predictions as an .npy body, or 400 if the tiles do not match the model input.
+        """
+        try:
+            X = decode_array(request.get_data())
+        except ValueError:
+            return jsonify({'message': 'Body must be an .npy array'}), 400
+        if X.ndim != 4 or tuple(X.shape[1:]) != tuple(app.model.input_shape[1:]):
+            return jsonify({'message': f'Expected tiles of shape {app.model.input_shape[1:]}, got {X.shape[1:]}'}), 400
+
+        response = make_response(encode_array(app.model.predict(X)))
+        response.headers['Content-Type'] = 'application/octet-stream'
+        return response
+
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve tile inference for the back-end.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5101)
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--xla', action='store_true', help='Compile the inference graphs with XLA.')
+    args = parser.parse_args()
+
+    create_worker_app(args.model, args.xla).run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,310 @@
+# This script load- and soak-tests the /upload endpoint of the DPIRD Intellicrop back-end end to end.
+# The main steps include:
+# 1. Generating a synthetic field (Blue, Green, Red, NIR, RedEdge and RGB GeoTIFFs) once, and packing it into a
+#    zip with a unique folder name for every request, as concurrent uploads of the same folder would collide.
+# 2. Serving the real Flask app in-process with a lightweight stand-in for model1.h5 and pointing the OpenAI client
+#    at a local stand-in server, so the whole pipeline runs without a GPU, model file or network access.
+#    With --url, an already running server (e.g. gunicorn with the real model) is driven instead.
+# 3. Firing uploads from a pool of concurrent clients for a number of requests or a duration, spread over a number
+#    of simulated users so that the fair scheduling of pipelines between users is exercised.
+# 4. Reporting throughput, p50/p95/p99 latency, error and rejection (429) rates, RSS growth and the temp files
+#    left behind, periodically during long soak runs and once at the end.
+#
+# Run from the back-end directory with, for example:
+#     python loadtest.py --concurrency 4 --requests 200
+#     python loadtest.py --concurrency 8 --duration 3600 --report-interval 60
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import psutil
+import rasterio
+import requests
+from rasterio.transform import from_origin
+from werkzeug.serving import make_server
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StubModel:
+    """
+    Lightweight stand-in for model1.h5 with the same input and output shapes.
+    The mask is derived from one input channel, and an optional delay per tile mimics the cost of real inference.
+    """
+
+    def __init__(self, input_shape=(None, 512, 512, 13), latency=0.0):
+        """
+        Parameters:
+        input_shape (tuple): The model input shape, batch dimension first.
+        latency (float): Seconds of simulated inference per tile. Default is 0.
+        """
+        self.input_shape = input_shape
+        self.latency = latency
+
+    def predict(self, X, verbose=0, **kwargs):
+        time.sleep(self.latency * len(X))
+        return np.tanh(4 * (X[..., 8:9] - 0.5)).astype(np.float32)  # Channel 8 is NDVI after reduce_channels()
+
+    def warm_up(self, batch_sizes=(1,)):
+        pass
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the OpenAI chat completion API, answering every request with a fixed suggestion.
+    """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({
+            'id': 'stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': 'stub',
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': 'Stub suggestion for load testing.'}}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def synthetic_field(size, seed=0):
+    """
+    Generate the GeoTIFFs of a synthetic field: smooth reflectance bands with vegetation and bare-soil patches.
+
+    Parameters:
+    size (int): Width and height of the field in pixels.
+    seed (int): Random seed. Default is 0.
+
+    Returns:
+    dict: A dictionary mapping each file name to its GeoTIFF bytes.
+    """
+    rng = np.random.default_rng(seed)
+    # Low-frequency vegetation cover upsampled to the field size
+    coarse = rng.random((size // 32 + 1, size // 32 + 1))
+    cover = np.kron(coarse, np.ones((32, 32)))[:size, :size]
+
+    bands = {
+        'Blue': 0.05 + 0.05 * (1 - cover),
+        'Green': 0.08 + 0.06 * cover,
+        'Red': 0.06 + 0.10 * (1 - cover),
+        'NIR': 0.20 + 0.40 * cover,
+        'RedEdge': 0.15 + 0.20 * cover,
+    }
+    files = {}
+    transform = from_origin(115.8, -31.9, 1e-6, 1e-6)
+
+    def to_tif(data):
+        with rasterio.MemoryFile() as memfile:
+            with memfile.open(driver='GTiff', height=size, width=size, count=data.shape[0], dtype='float32',
+                              crs='EPSG:4326', transform=transform) as dst:
+                dst.write(data.astype(np.float32))
+            return memfile.read()
+
+    for name, band in bands.items():
+        noisy = band + rng.normal(0, 0.005, band.shape)
+        files[f'{name}_1_1.tif'] = to_tif(noisy[np.newaxis])
+    rgb = np.stack([bands['Red'], bands['Green'], bands['Blue']])
+    files['RGB_1_1.tif'] = to_tif(rgb)
+
+    return files
+
+def field_zip(files):
+    """
+    Pack the field files into a zip with a unique top-level folder.
+
+    Parameters:
+    files (dict): File name to bytes, as returned by synthetic_field().
+
+    Returns:
+    tuple: The zip file name and its bytes.
+    """
+    folder = f'field_{uuid.uuid4().hex[:12]}'
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr(f'{folder}/', '')
+        for name, data in files.items():
+            zf.writestr(f'{folder}/{name}', data)
+    return f'{folder}.zip', buf.getvalue()
+
+def count_files(root):
+    """
+    Count the files under a directory.
+
+    Parameters:
+    root (str): The directory.
+
+    Returns:
+    int: The number of files, 0 if the directory does not exist.
+    """
+    return sum(len(files) for _, _, files in os.walk(root))
+
+def start_in_process_server(args):
+    """
+    Start the Flask app with the stub model, and the stub LLM server, on background threads.
+
+    Parameters:
+    args (argparse.Namespace): The command line arguments.
+
+    Returns:
+    str: The base URL of the app.
+    """
+    sys.path.insert(0, BACKEND_DIR)
+    import openai
+    import app as backend
+    from routes.backpressure import create_pipeline_scheduler
+
+    llm_server = ThreadingHTTPServer(('127.0.0.1', 0), StubLLMHandler)
+    threading.Thread(target=llm_server.serve_forever, daemon=True).start()
+    openai.api_key = 'stub'
+    openai.api_base = f'http://127.0.0.1:{llm_server.server_port}/v1'
+
+    application = backend.create_app()
+    application.pipeline_scheduler = create_pipeline_scheduler(args.max_pipelines, backend.SCHEDULER_FOLDER)
+    application.model = StubModel(latency=args.model_latency)
+    for directory in backend.REQUIRED_DIRECTORIES:
+        os.makedirs(directory, exist_ok=True)
+
+    server = make_server('127.0.0.1', 0, application, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+class Metrics:
+    """
+    Thread-safe collection of request outcomes and memory samples.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.rejected = 0
+        self.rss_start = process.memory_info().rss if process else None
+        self.rss_max = self.rss_start
+
+    def record(self, latency, ok, rejected):
+        with self.lock:
+            if rejected:
+                self.rejected += 1
+            elif ok:
+                self.latencies.append(latency)
+            else:
+                self.errors += 1
+
+    def sample_rss(self):
+        if self.process is None:
+            return None
+        rss = self.process.memory_info().rss
+        with self.lock:
+            self.rss_max = max(self.rss_max, rss)
+        return rss
+
+    def report(self, elapsed, temp_files_start, title):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            total = len(latencies) + self.errors + self.rejected
+            lines = [f"--- {title} after {elapsed:.0f}s ---",
+                     f"requests: {total}, ok: {len(latencies)}, errors: {self.errors}, rejected (429): {self.rejected}",
+                     f"throughput: {len(latencies) / elapsed:.2f} req/s, "
+                     f"error rate: {100 * self.errors / max(total, 1):.2f}%, "
+                     f"rejection rate: {100 * self.rejected / max(total, 1):.2f}%"]
+            if len(latencies):
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+                lines.append(f"latency ms: p50 {p50:.0f}, p95 {p95:.0f}, p99 {p99:.0f}, max {latencies.max():.0f}")
+        rss = self.sample_rss()
+        if rss is not None:
+            lines.append(f"RSS MB: start {self.rss_start / 1024 ** 2:.0f}, now {rss / 1024 ** 2:.0f}, "
+                         f"max {self.rss_max / 1024 ** 2:.0f}, growth {(rss - self.rss_start) / 1024 ** 2:+.0f}")
+        leaked = count_files('tmp') + count_files('uploads') - temp_files_start
+        lines.append(f"temp files left behind: {leaked} ({leaked / max(total, 1):.1f} per request)")
+        print("\n".join(lines), flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load and soak test for the /upload endpoint.')
+    parser.add_argument('--url', help='Drive an already running server instead of the in-process app with stubs.')
+    parser.add_argument('--server-pid', type=int, help='PID of the --url server, to sample its RSS.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of concurrent clients.')
+    parser.add_argument('--requests', type=int, default=50, help='Total uploads to send (ignored with --duration).')
+    parser.add_argument('--duration', type=float, help='Keep sending uploads for this many seconds (soak test).')
+    parser.add_argument('--report-interval', type=float, default=30, help='Seconds between interim reports.')
+    parser.add_argument('--field-size', type=int, default=512, help='Width and height of the synthetic field.')
+    parser.add_argument('--model-latency', type=float, default=0.05, help='Stub model seconds per tile.')
+    parser.add_argument('--users', type=int, default=1, help='Number of simulated users the clients are spread over.')
+    parser.add_argument('--max-pipelines', type=int, default=4, help='Concurrent pipeline limit of the in-process app.')
+    parser.add_argument('--workdir', help='Working directory for the in-process app (default: a new temp dir).')
+    args = parser.parse_args()
+
+    files = synthetic_field(args.field_size)
+
+    if args.url:
+        url, process = args.url.rstrip('/'), psutil.Process(args.server_pid) if args.server_pid else None
+    else:
+        os.chdir(args.workdir or tempfile.mkdtemp(prefix='agrivision-loadtest-'))
+        print(f"Working directory: {os.getcwd()}")
+        url, process = start_in_process_server(args), psutil.Process()
+
+    metrics = Metrics(process)
+    temp_files_start = count_files('tmp') + count_files('uploads')
+    start = time.time()
+    deadline = start + args.duration if args.duration else None
+    remaining = [args.requests]
+    remaining_lock = threading.Lock()
+
+    def client(index):
+        session = requests.Session()
+        username = f'loadtest-user-{index % args.users}'
+        while True:
+            if deadline is not None:
+                if time.time() >= deadline:
+                    return
+            else:
+                with remaining_lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+
+            name, data = field_zip(files)
+            sent = time.perf_counter()
+            try:
+                response = session.post(f'{url}/upload', params={'username': username},
+                                        files={'file': (name, data, 'application/zip')}, timeout=600)
+                ok = response.status_code == 200 and response.json().get('status') == 1
+                rejected = response.status_code == 429
+            except (requests.RequestException, ValueError):
+                ok, rejected = False, False
+            metrics.record(time.perf_counter() - sent, ok, rejected)
+
+    done = threading.Event()
+
+    def reporter():
+        # Sample RSS every second to catch peaks, and print an interim report every report interval
+        next_report = start + args.report_interval
+        while not done.wait(1):
+            metrics.sample_rss()
+            if time.time() >= next_report:
+                metrics.report(time.time() - start, temp_files_start, 'interim')
+                next_report += args.report_interval
+
+    threading.Thread(target=reporter, daemon=True).start()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for index in range(args.concurrency):
+            pool.submit(client, index)
+    done.set()
+
+    metrics.report(time.time() - start, temp_files_start, 'final')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+# This script schedules the processing pipelines of the DPIRD Intellicrop project.
+# The main features include:
+# 1. A bound on the pipelines running at once, shared by every worker process: the scheduler state lives in a small
+#    file under an exclusive lock, created once in the master process, so the limit applies to the whole server.
+# 2. Self-clocked fair queueing across users: every waiting upload gets a virtual finish time from its size, the
+#    free slots go to the earliest finish times, and the virtual time moves to the finish time of each upload granted.
+#    Small uploads therefore overtake multi-gigabyte ones, yet the finish times of later arrivals keep growing past
+#    those of large uploads, which are never starved. A user submitting many fields only gets their share while
+#    others are waiting. An upload turned away keeps its finish time for a retry of the same size, so large uploads
+#    move forward across retries. Users are told apart by the unverified 'username'
+#    query parameter, so fairness is advisory: it orders honest clients, but a client can claim another name.
+# 3. Two waits before a request is turned away with 429 and a Retry-After header: a short one while other uploads
+#    are ahead of it, and a longer one once it is next in line, so that an upload moved to the front is not
+#    rejected while it waits for a running pipeline to finish.
+# 4. Per-user wait-time metrics (jobs, rejections, mean, p50, p95 and max wait), served to admins by /scheduler/stats.
+#    They are kept in a separate file, written once per grant or rejection, so that polling waiters only read the
+#    small queue state.
+# Waiting and running entries of worker processes that died are dropped, so a crash never leaks a slot.
+
+import fcntl
+import functools
+import json
+import os
+import time
+import uuid
+import numpy as np
+from flask import Blueprint, jsonify, make_response, request, current_app
+from .profiling import profiling_authorized
+
+backpressure_bp = Blueprint('backpressure', __name__)
+
+# Fixed cost added to every upload, so that tiny uploads are not free and count like a small field
+JOB_OVERHEAD_MB = 8
+
+# Seconds between checks of a waiting upload for a free slot, doubling from the first to the last while it waits
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+
+# Number of recent waits kept per user for the percentiles
+RECENT_WAITS = 200
+
+# Users kept in the metrics; the least recently seen are dropped beyond this
+MAX_TRACKED_USERS = 1000
+
+# Seconds the virtual times of a rejected upload are kept for a retry
+RETRY_HOLD = 600
+
+
+def pid_alive(pid):
+    """
+    Check whether a process exists, e.g. the worker that owns a queue entry or a background job.
+
+    Parameters:
+    pid (int): The process id.
+
+    Returns:
+    bool: True if the process is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class PipelineScheduler:
+    """
+    Fair scheduler of pipeline executions, shared by all worker processes through locked state files.
+    """
+
+    def __init__(self, limit, folder):
+        """
+        Parameters:
+        limit (int): The maximum number of pipelines that may run at once.
+        folder (str): Directory holding the state, metrics and lock files.
+        """
+        self.limit = limit
+        self.state_path = os.path.join(folder, 'scheduler.json')
+        self.lock_path = os.path.join(folder, 'scheduler.lock')
+        self.metrics_path = os.path.join(folder, 'scheduler_metrics.json')
+        self.metrics_lock_path = os.path.join(folder, 'scheduler_metrics.lock')
+        os.makedirs(folder, exist_ok=True)
+        with self._locked(self.lock_path):
+            self._save(self.state_path, self._empty_state())
+        with self._locked(self.metrics_lock_path):
+            self._save(self.metrics_path, {})
+
+    @staticmethod
+    def _empty_state():
+        return {'virtual_time': 0.0, 'waiting': {}, 'running': {}, 'finish': {}, 'held': {}}
+
+    @staticmethod
+    def _locked(lock_path):
+        lock_file = open(lock_path, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file  # Closing the file releases the lock
+
+    def _load(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return self._empty_state()
+
+    @staticmethod
+    def _save(path, data):
+        # Write then rename, so that a process killed mid-write never leaves a corrupt file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _prune(self, state):
+        """
+        Drop the entries of worker processes that are gone, the finish times of users that are no longer ahead
+        of the virtual time, as those users start from the virtual time anyway, and the expired tags held for retries.
+
+        Returns:
+        bool: True if the state changed.
+        """
+        changed = False
+        for table in ('waiting', 'running'):
+            for ticket, entry in list(state[table].items()):
+                if not pid_alive(entry['pid']):
+                    del state[table][ticket]
+                    changed = True
+        for user, finish in list(state['finish'].items()):
+            if finish <= state['virtual_time']:
+                del state['finish'][user]
+                changed = True
+        held = state.setdefault('held', {})
+        for user, tags in list(held.items()):
+            if tags['expires'] < time.time():
+                del held[user]
+                changed = True
+        return changed
+
+    def _record(self, user, wait=None):
+        """
+        Add a grant, or a rejection if no wait is given, to the metrics of a user.
+        """
+        with self._locked(self.metrics_lock_path):
+            try:
+                with open(self.metrics_path) as f:
+                    metrics = json.load(f)
+            except (FileNotFoundError, ValueError):
+                metrics = {}
+            if user not in metrics:
+                if len(metrics) >= MAX_TRACKED_USERS:
+                    del metrics[min(metrics, key=lambda u: metrics[u]['last_seen'])]
+                metrics[user] = {'jobs': 0, 'rejected': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'recent_waits': []}
+            user_metrics = metrics[user]
+            user_metrics['last_seen'] = time.time()
+            if wait is None:
+                user_metrics['rejected'] += 1
+            else:
+                user_metrics['jobs'] += 1
+                user_metrics['wait_total'] += wait
+                user_metrics['wait_max'] = max(user_metrics['wait_max'], wait)
+                user_metrics['recent_waits'] = (user_metrics['recent_waits'] + [round(wait, 3)])[-RECENT_WAITS:]
+            self._save(self.metrics_path, metrics)
+
+    def acquire(self, user, size, timeout=None, scheduled_timeout=None):
+        """
+        Queue a pipeline execution and wait for its turn.
+
+        Parameters:
+        user (str): The user submitting the upload.
+        size (int): Size of the upload in bytes, or 0 if unknown.
+        timeout (float): Seconds to wait while other uploads are ahead in the queue, or None to wait indefinitely.
+        scheduled_timeout (float): Seconds to wait in total once the upload is next in line for a slot.
+                                   Default is timeout.
+
+        Returns:
+        str: A ticket to pass to release(), or None if no slot was granted within the timeouts.
+        """
+        ticket = uuid.uuid4().hex
+        arrived = time.time()
+        cost = size / 1024 ** 2 + JOB_OVERHEAD_MB
+        if scheduled_timeout is None:
+            scheduled_timeout = timeout
+
+        with self._locked(self.lock_path):
+            state = self._load()
+            self._prune(state)
+            held = state['held'].pop(user, None)
+            if held is not None and held['size'] == size:
+                start, finish = held['start'], held['finish']  # A retry keeps the place of the rejected attempt
+            else:
+                start = max(state['virtual_time'], state['finish'].get(user, 0.0))
+                finish = start + cost
+                state['finish'][user] = finish
+            waiting = {'user': user, 'pid': os.getpid(), 'arrived': arrived, 'start': start, 'finish': finish}
+            state['waiting'][ticket] = waiting
+            self._save(self.state_path, state)
+
+        interval = POLL_INTERVAL
+        while True:
+            with self._locked(self.lock_path):
+                state = self._load()
+                changed = self._prune(state)
+                if ticket not in state['waiting']:
+                    state['waiting'][ticket] = waiting  # The state was reset meanwhile, e.g. by a restarted master
+                    changed = True
+                # The free slots go to the waiting uploads with the earliest virtual finish times
+                order = sorted(state['waiting'], key=lambda t: (state['waiting'][t]['finish'],
+                                                                state['waiting'][t]['arrived']))
+                position = order.index(ticket)
+                granted = position < self.limit - len(state['running'])
+
+                waited = time.time() - arrived
+                limit = scheduled_timeout if position < self.limit else timeout
+                if not granted and limit is not None and waited >= limit:
+                    entry = state['waiting'].pop(ticket)
+                    # Keep the virtual times of the rejected upload, so that its retry does not queue from the back
+                    state['held'][user] = {'size': size, 'start': entry['start'], 'finish': entry['finish'],
+                                           'expires': time.time() + RETRY_HOLD}
+                    self._save(self.state_path, state)
+                    rejected = True
+                elif granted:
+                    entry = state['waiting'].pop(ticket)
+                    state['virtual_time'] = max(state['virtual_time'], entry['finish'])
+                    state['running'][ticket] = {'user': user, 'pid': os.getpid(), 'started': time.time()}
+                    self._save(self.state_path, state)
+                    rejected = False
+                else:
+                    if changed:
+                        self._save(self.state_path, state)
+                    rejected = None
+
+            if rejected is not None:
+                self._record(user, None if rejected else waited)
+                return None if rejected else ticket
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    def release(self, ticket):
+        """
+        Free the slot of a pipeline execution granted by acquire().
+
+        Parameters:
+        ticket (str): The ticket returned by acquire().
+        """
+        with self._locked(self.lock_path):
+            state = self._load()
+            if state['running'].pop(ticket, None) is not None:
+                self._save(self.state_path, state)
+
+    def stats(self):
+        """
+        Summarize the queue and the wait times per user.
+
+        Returns:
+        dict: The running and waiting counts, and per user the jobs, rejections and wait-time statistics in seconds.
+        """
+        with self._locked(self.lock_path):
+            state = self._load()
+        with self._locked(self.metrics_lock_path):
+            try:
+                with open(self.metrics_path) as f:
+                    metrics = json.load(f)
+            except (FileNotFoundError, ValueError):
+                metrics = {}
+        users = {}
+        for user, user_metrics in metrics.items():
+            waits = user_metrics['recent_waits']
+            jobs = user_metrics['jobs']
+            users[user] = {
+                'jobs': jobs,
+                'rejected': user_metrics['rejected'],
+                'waiting': sum(1 for entry in state['waiting'].values() if entry['user'] == user),
+                'running': sum(1 for entry in state['running'].values() if entry['user'] == user),
+                'wait_mean': round(user_metrics['wait_total'] / jobs, 3) if jobs else None,
+                'wait_p50': round(float(np.percentile(waits, 50)), 3) if waits else None,
+                'wait_p95': round(float(np.percentile(waits, 95)), 3) if waits else None,
+                'wait_max': round(user_metrics['wait_max'], 3),
+            }
+        return {'limit': self.limit, 'running': len(state['running']), 'waiting': len(state['waiting']),
+                'users': users}
+
+def create_pipeline_scheduler(limit, folder):
+    """
+    Create the scheduler that bounds and orders concurrent pipeline executions.
+    It must be created before the workers are forked, as creating it resets the shared state.
+
+    Parameters:
+    limit (int): The maximum number of pipelines that may run at once.
+    folder (str): Directory holding the shared state.
+
+    Returns:
+    PipelineScheduler: The shared scheduler.
+    """
+    return PipelineScheduler(limit, folder)
+
+def request_user():
+    """
+    Identify the user of the current request for scheduling: the 'username' query parameter, or the client address.
+    The form is not used so that the body is not read before the request has a slot. The name is not verified, so
+    it only serves fairness between honest clients and must not grant any privilege.
+
+    Returns:
+    str: The user key.
+    """
+    return request.args.get('username') or request.remote_addr or 'anonymous'
+
+def acquire_pipeline_slot(user, size):
+    """
+    Queue for a pipeline slot, waiting at most PIPELINE_QUEUE_TIMEOUT seconds behind other uploads, and at most
+    PIPELINE_SCHEDULED_TIMEOUT seconds in total once next in line.
+
+    Parameters:
+    user (str): The user submitting the upload.
+    size (int): Size of the upload in bytes, or 0 if unknown.
+
+    Returns:
+    str: A ticket that must be released with release_pipeline_slot(), or None if saturated.
+    """
+    return current_app.pipeline_scheduler.acquire(user, size, timeout=current_app.config['PIPELINE_QUEUE_TIMEOUT'],
+                                                  scheduled_timeout=current_app.config['PIPELINE_SCHEDULED_TIMEOUT'])
+
+def release_pipeline_slot(ticket):
+    """
+    Release a pipeline slot reserved with acquire_pipeline_slot().
+
+    Parameters:
+    ticket (str): The ticket returned by acquire_pipeline_slot().
+    """
+    current_app.pipeline_scheduler.release(ticket)
+
+def busy_response():
+    """
+    Build the response returned when no pipeline slot was granted in time.
+
+    Returns:
+    Flask response: A 429 response with a Retry-After header.
+    """
+    response = jsonify({'status': 0, 'message': 'Server is busy, please retry later'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(current_app.config['PIPELINE_RETRY_AFTER'])
+    return response
+
+def limit_pipelines(view):
+    """
+    Decorator that runs a view once the scheduler grants it a pipeline slot, or answers 429 when none is granted
+    in time. The upload size is taken from the Content-Length header, and the time spent queueing is reported
+    in the X-Queue-Wait header.
+
+    Parameters:
+    view (function): The Flask view function running the pipeline.
+
+    Returns:
+    function: The wrapped view.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'OPTIONS':
+            return view(*args, **kwargs)  # CORS preflight does not run the pipeline
+        queued = time.time()
+        ticket = acquire_pipeline_slot(request_user(), request.content_length or 0)
+        if ticket is None:
+            return busy_response()
+        waited = time.time() - queued
+        try:
+            response = make_response(view(*args, **kwargs))
+        finally:
+            release_pipeline_slot(ticket)
+        response.headers['X-Queue-Wait'] = f'{waited:.3f}'
+        return response
+
+    return wrapper
+
+@backpressure_bp.route('/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    """
+    Serves the pipeline queue and the per-user wait-time metrics. Requires the admin token (see routes.profiling).
+
+    Returns:
+    JSON response: The scheduler statistics.
+    """
+    if not profiling_authorized():
+        return jsonify({'status': 0, 'message': 'Forbidden'}), 403
+    return jsonify({'status': 1, **current_app.pipeline_scheduler.stats()})
@@ -0,0 +1,290 @@
+# This script implements resumable, chunked uploads of large drone ZIP files for the DPIRD Intellicrop project.
+# The main features include:
+# 1. Starting an upload session that records the file name, total size, optional checksum and processing options.
+# 2. Streaming each chunk straight from the request body to a partial file with bounded memory,
+#    hashing it on the fly. The SHA-256 of every chunk is kept in the session file, so any worker process can take
+#    the next chunk and the checksum of the whole upload (a SHA-256 over the chunk digests) needs no extra pass.
+# 3. Reporting the number of bytes received so that a client can resume after a network drop.
+# 4. Moving the finished file into the upload folder and running the processing pipeline as soon as the last chunk lands.
+# 5. Expiring abandoned uploads after UPLOAD_SESSION_TTL seconds without a chunk.
+
+import hashlib
+import json
+import os
+import time
+import uuid
+import fcntl
+from flask import Blueprint, jsonify, request, current_app
+from werkzeug.utils import secure_filename
+from .file_operations import allowed_file, parse_pipeline_options, process_upload
+from .backpressure import acquire_pipeline_slot, release_pipeline_slot, busy_response, request_user
+from .preflight import validate_upload_zip
+from .profiling import profiling_authorized, run_profiled
+
+chunked_upload_bp = Blueprint('chunked_upload', __name__)
+
+# Size of the blocks copied from the request stream to disk
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+# Seconds without a new chunk after which an upload is abandoned and its files deleted
+UPLOAD_SESSION_TTL = 24 * 3600
+
+def _partial_folder():
+    """
+    Return the folder holding partial uploads, creating it if needed.
+
+    Returns:
+    str: Path of the partial upload folder.
+    """
+    folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'partial')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def _session_paths(upload_id):
+    """
+    Return the paths of the session file and the partial data file of an upload.
+
+    Parameters:
+    upload_id (str): The upload id returned when the session was started.
+
+    Returns:
+    tuple: The session (.json) path and the partial data (.part) path.
+    """
+    folder = _partial_folder()
+    return os.path.join(folder, f'{upload_id}.json'), os.path.join(folder, f'{upload_id}.part')
+
+def _load_session(upload_id):
+    """
+    Load the session of an upload.
+
+    Parameters:
+    upload_id (str): The upload id returned when the session was started.
+
+    Returns:
+    dict: The session, or None if the upload id is unknown.
+    """
+    try:
+        uuid.UUID(upload_id)  # Reject anything that is not one of our ids before touching the file system
+    except ValueError:
+        return None
+
+    session_path, _ = _session_paths(upload_id)
+    if not os.path.exists(session_path):
+        return None
+    with open(session_path) as f:
+        return json.load(f)
+
+def _save_session(session_path, session):
+    """
+    Write the session of an upload, atomically so that other workers never read a half-written file.
+
+    Parameters:
+    session_path (str): Path of the session file.
+    session (dict): The session.
+    """
+    with open(session_path + '.tmp', 'w') as f:
+        json.dump(session, f)
+    os.replace(session_path + '.tmp', session_path)
+
+def chunk_list_digest(chunk_digests):
+    """
+    Compute the checksum of a chunked upload: the SHA-256 of the concatenated binary SHA-256 digests of its chunks,
+    in upload order. Clients compute the same value over the chunks they send.
+
+    Parameters:
+    chunk_digests (list): The hex SHA-256 of each chunk.
+
+    Returns:
+    str: The hex checksum.
+    """
+    hasher = hashlib.sha256()
+    for digest in chunk_digests:
+        hasher.update(bytes.fromhex(digest))
+    return hasher.hexdigest()
+
+def _expire_sessions(folder):
+    """
+    Delete the files of uploads that have not received a chunk for UPLOAD_SESSION_TTL seconds.
+    The session file is rewritten with every chunk, so its modification time is the time of the last chunk.
+
+    Parameters:
+    folder (str): The partial upload folder.
+    """
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for file in os.listdir(folder):
+        path = os.path.join(folder, file)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                print(f"Expired abandoned upload file {path}")
+        except FileNotFoundError:
+            pass  # Completed or expired by another worker meanwhile
+
+@chunked_upload_bp.route('/upload/chunked', methods=['POST'])
+def start_upload():
+    """
+    Starts a chunked upload session.
+
+    Parameters:
+    filename (str): Name of the ZIP file being uploaded.
+    total_size (int): Total size of the file in bytes.
+    sha256 (str): Optional checksum of the whole file, see chunk_list_digest(), checked when the last chunk arrives.
+    export, export_dtype, sparse, nan_policy (str): Optional processing options, as for /upload.
+    username (str): Optional user name, used to share the pipelines fairly between users.
+
+    Returns:
+    JSON response: The upload id and the maximum chunk size accepted by the server.
+    """
+    filename = secure_filename(request.form.get('filename', ''))
+    try:
+        total_size = int(request.form.get('total_size', ''))
+    except ValueError:
+        return jsonify({'status': 0, 'message': 'total_size is required'}), 400
+
+    if not filename or not allowed_file(filename) or total_size <= 0:
+        return jsonify({'status': 0, 'message': 'Invalid file name or size'}), 400
+
+    options = parse_pipeline_options(request.form)
+    if options is None:
+        return jsonify({'status': 0, 'message': 'Unsupported processing option'}), 400
+
+    _expire_sessions(_partial_folder())
+
+    upload_id = str(uuid.uuid4())
+    session = {
+        'filename': filename,
+        'total_size': total_size,
+        'sha256': request.form.get('sha256', '').lower() or None,
+        'options': options,
+        'user': request.form.get('username') or request_user(),
+        'received': 0,
+        'chunks': [],  # Hex SHA-256 of each chunk received
+    }
+    session_path, part_path = _session_paths(upload_id)
+    open(part_path, 'wb').close()
+    _save_session(session_path, session)
+
+    return jsonify({'status': 1, 'upload_id': upload_id, 'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE']})
+
+@chunked_upload_bp.route('/upload/chunked/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """
+    Reports how many bytes of an upload have been received, so that an interrupted client can resume.
+
+    Parameters:
+    upload_id (str): The upload id returned by /upload/chunked.
+
+    Returns:
+    JSON response: The received offset and the total size.
+    """
+    session = _load_session(upload_id)
+    if session is None:
+        return jsonify({'status': 0, 'message': 'Unknown upload'}), 404
+
+    return jsonify({'status': 1, 'offset': session['received'], 'total_size': session['total_size']})
+
+@chunked_upload_bp.route('/upload/chunked/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """
+    Appends one chunk, sent as the raw request body, to an upload.
+    The query parameter 'offset' must equal the number of bytes already received; otherwise the server answers
+    409 with the current offset so the client can continue from there.
+    An optional X-Chunk-SHA256 header is checked against the chunk; a corrupted chunk is dropped and answered with 422.
+    When the last chunk completes the file it is verified and processed, and the response is the same as for /upload,
+    profiled if the last chunk carries the admin profiling token.
+    If no pipeline slot is free the last chunk is refused with 429 and Retry-After before its body is read.
+
+    Parameters:
+    upload_id (str): The upload id returned by /upload/chunked.
+
+    Returns:
+    JSON response: The new offset, or the processing results once the upload is complete.
+    """
+    session = _load_session(upload_id)
+    if session is None:
+        return jsonify({'status': 0, 'message': 'Unknown upload'}), 404
+
+    length = request.content_length
+    if length is None or length > current_app.config['UPLOAD_CHUNK_SIZE']:
+        return jsonify({'status': 0, 'message': 'Chunk is missing a length or is too large'}), 413
+
+    session_path, part_path = _session_paths(upload_id)
+    try:
+        part_file = open(part_path, 'r+b')
+    except FileNotFoundError:
+        return jsonify({'status': 0, 'message': 'Upload already completed'}), 409
+
+    ticket = None
+    try:
+        with part_file:
+            # Serialise writers of the same upload across threads and worker processes
+            fcntl.flock(part_file, fcntl.LOCK_EX)
+            session = _load_session(upload_id)  # Reload under the lock, another worker may have appended meanwhile
+            if session is None:
+                return jsonify({'status': 0, 'message': 'Upload already completed'}), 409
+
+            # Bytes beyond the recorded offset belong to a chunk whose worker died before recording it
+            offset = session['received']
+            part_file.truncate(offset)
+            if request.args.get('offset', type=int) != offset or offset + length > session['total_size']:
+                return jsonify({'status': 0, 'message': 'Offset mismatch', 'offset': offset}), 409
+
+            if offset + length == session['total_size']:
+                # Reserve the pipeline before reading the last chunk so a saturated server can refuse it untouched
+                ticket = acquire_pipeline_slot(session.get('user') or request_user(), session['total_size'])
+                if ticket is None:
+                    return busy_response()
+
+            hasher = hashlib.sha256()
+            part_file.seek(offset)
+            received = 0
+            while received < length:
+                block = request.stream.read(min(STREAM_BLOCK_SIZE, length - received))
+                if not block:
+                    break
+                part_file.write(block)
+                hasher.update(block)
+                received += len(block)
+
+            if received < length:
+                # The connection dropped mid-chunk; drop the partial chunk so the client resends it whole
+                part_file.truncate(offset)
+                return jsonify({'status': 0, 'message': 'Incomplete chunk', 'offset': offset}), 400
+
+            chunk_digest = hasher.hexdigest()
+            expected = request.headers.get('X-Chunk-SHA256', '').lower()
+            if expected and expected != chunk_digest:
+                part_file.truncate(offset)
+                return jsonify({'status': 0, 'message': 'Chunk checksum mismatch', 'offset': offset}), 422
+
+            part_file.flush()
+            offset += received
+            session['received'] = offset
+            session['chunks'].append(chunk_digest)
+            if offset < session['total_size']:
+                _save_session(session_path, session)
+                return jsonify({'status': 1, 'offset': offset, 'total_size': session['total_size']})
+
+            # Last chunk: verify and hand the file to the pipeline without copying it
+            os.remove(session_path)
+            digest = chunk_list_digest(session['chunks'])
+            if session['sha256'] and session['sha256'] != digest:
+                os.remove(part_path)
+                return jsonify({'status': 0, 'message': 'Checksum mismatch', 'sha256': digest}), 422
+
+            src_path = os.path.join(current_app.config['UPLOAD_FOLDER'], session['filename'])
+            os.replace(part_path, src_path)
+
+        report = validate_upload_zip(src_path)
+        if not report['valid']:
+            return jsonify({'status': 0, 'message': 'Invalid upload', 'errors': report['errors'], 'sha256': digest}), 400
+
+        if profiling_authorized():
+            result = run_profiled(process_upload, src_path, request.host_url, **session['options'])
+        else:
+            result = process_upload(src_path, request.host_url, **session['options'])
+        result['sha256'] = digest
+        return jsonify(result)
+    finally:
+        if ticket is not None:
+            release_pipeline_slot(ticket)
@@ -5,6 +5,8 @@
 # 3. Saving the results (input images, predicted mask) and providing URLs for accessing these files.
 # 4. Using OpenAI's GPT model to analyze weed data and provide agricultural suggestions based on the results.
 # 5. Supporting file downloads and displaying images from temporary directories.
+# 6. Optionally exporting the predicted mask as a georeferenced GeoTIFF and weed polygons as GeoJSON.
+# 7. Progressive uploads that return a low-resolution preview first and the full-resolution results later.
 
 import zipfile
 import shutil
@@ -13,22 +15,51 @@ from flask_cors import cross_origin
 from werkzeug.utils import secure_filename
 import os
 import datetime
+import json
+import threading
+import time
+import uuid
 import core.main
+import core.export
+from core.normalize import NAN_POLICIES
 import openai
-from .process_indices import process_zip_and_calculate_indices
+from .process_indices import process_zip_and_calculate_indices, calculate_preview_indices
+from .preflight import validate_upload_zip
+from .backpressure import limit_pipelines, request_user, busy_response, pid_alive
+from .profiling import profiling_authorized, run_profiled
 
 openai.api_key = ""  # This is api-key for OpenAI and it should be replaced by your own
 
 file_ops_bp = Blueprint('file_ops', __name__)
 
+# Full-resolution runs of progressive uploads queued or running in this worker process
+_background_jobs = 0
+_background_lock = threading.Lock()
+
 @file_ops_bp.route('/upload', methods=['POST', 'OPTIONS'])
-@cross_origin(origins="*", methods=['POST', 'OPTIONS'], allow_headers=['Content-Type'])
+@cross_origin(origins="*", methods=['POST', 'OPTIONS'], allow_headers=['Content-Type', 'X-Profile-Token'])
+@limit_pipelines
 def upload_file():
     """
     Handles file uploads, specifically .zip files, for processing.
     The function saves the uploaded file, extracts its contents, processes the images,
     and generates weed identification predictions using a machine learning model.
 
+    With the form field 'progressive' set to 1, a low-resolution preview is returned within seconds together with a
+    'result_url' that serves the full-resolution results once they are ready.
+
+    The optional form field 'export' takes a comma-separated list of mask export formats ('geotiff', 'geojson'),
+    and 'export_dtype' selects the GeoTIFF quantization ('int8' scores or a 'uint8' class map).
+    With 'sparse' set to 1, the model only runs on tiles that contain vegetation.
+    'nan_policy' selects how pixels with a missing index value are handled: 'mask' (default) predicts "other"
+    there, 'fill' runs the model on them with each missing index set to the normalized value of a raw 0.
+    Admins can profile the pipeline by sending the X-Profile-Token header (see routes.profiling).
+    Uploads missing bands or with inconsistent band headers are rejected with 400 before processing (see routes.preflight).
+
+    At most MAX_CONCURRENT_PIPELINES uploads are processed at once, shared fairly between users (the unverified
+    'username' query parameter) with smaller uploads first; a request not granted a slot in time (see
+    routes.backpressure) is answered with 429 and a Retry-After header before the body is read.
+
     Returns a JSON response with URLs to the processed images and analysis results, including weed removal suggestions.
     """
     if request.method == 'OPTIONS':
@@ -38,6 +69,10 @@ def upload_file():
     print(datetime.datetime.now(), file.filename)
 
     if file and allowed_file(file.filename):
+        options = parse_pipeline_options(request.form)
+        if options is None:
+            return jsonify({'status': 0, 'message': 'Unsupported processing option'})
+
         filename = secure_filename(file.filename)
         print("filename", filename)
         zip_name = filename.rsplit('.', 1)[0]  # Get the file name without the extension
@@ -45,64 +80,256 @@ def upload_file():
         src_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
         file.save(src_path)
 
-        # Extract ZIP file
-        with zipfile.ZipFile(src_path, 'r') as zip_ref:
-            zip_ref.extractall('./tmp/ct')
-
-        folder_name = get_single_folder_name_from_zip(src_path)
-        print("folder_name", folder_name)
-        output_folder = os.path.join('./tmp/ct', folder_name)
-
-        print("src_path, output_folder", src_path, output_folder)
-
-        # Process images and calculate indices
-        process_zip_and_calculate_indices(src_path, output_folder)
-
-        # Call other processing logic
-        pid, input_images, predicted_mask, image_info, spectrum_names = core.main.c_main(
-            output_folder, current_app.model)
-
-        print("openai-version", openai.__version__)
-
-        # Analyze image_info using GPT to get weed removal suggestions
-        analysis_prompt = f"""
-        The DPIRD AgriVision platform is an expert platform developed by the Department of Agriculture of Western Australia, designed for further analysis of
-        weed identification results and providing AI-driven professional advice. You are now serving as a professional agricultural consultant on this
-        platform. Based on the weed information from the test field we provide, combined with your professional agricultural knowledge and the remote
-        sensing knowledge base, please provide detailed explanations and analysis. Additionally, give guidance tailored to the specific conditions of
-        Western Australia (such as environment, climate, soil, rainfall, etc.). If there is a high weed density, provide a clear warning based on the
-        national context of Australia, and offer advanced analysis.
-        The image shows {image_info['Vegetation']} vegetation, {image_info['Weed']} weed, and {image_info['Misc/Other']} miscellaneous or other elements. 
-        Attention: Don't have markdown formatting. Do not bold text. No "*" in output. Different points suggest subparagraphs.
-        """
-        weed_removal_suggestions = analyze_text(analysis_prompt)
-        print("suggestions", weed_removal_suggestions)
-
-        # Create directories if they don't exist
-        os.makedirs('./tmp/input', exist_ok=True)
-        os.makedirs('./tmp/draw', exist_ok=True)
+        # Reject incomplete or inconsistent fields from their metadata before any pixel is decoded
+        report = validate_upload_zip(src_path)
+        if not report['valid']:
+            return jsonify({'status': 0, 'message': 'Invalid upload', 'errors': report['errors']}), 400
+
+        if request.form.get('progressive') in ('1', 'true'):
+            preview = start_progressive_upload(src_path, request.host_url, **options)
+            if preview is None:
+                return busy_response()
+            return jsonify(preview)
+
+        if profiling_authorized():
+            return jsonify(run_profiled(process_upload, src_path, request.host_url, **options))
 
-        # Save all input images and the predicted mask
-        input_image_urls = []
-        for img, name in zip(input_images, spectrum_names):
-            input_image_path = f'./tmp/input/{pid}_{name}.png'
-            img.save(input_image_path)
-            input_image_urls.append(f'{request.host_url}tmp/input/{pid}_{name}.png')
-
-        predicted_mask_path = f'./tmp/draw/{pid}_predicted.png'
-        predicted_mask.save(predicted_mask_path)
-
-        return jsonify({
-            'status': 1,
-            'input_image_urls': input_image_urls,
-            'spectrum_names': spectrum_names,
-            'predicted_mask_url': f'{request.host_url}tmp/draw/{pid}_predicted.png',
-            'image_info': image_info,
-            'weed_removal_suggestions': weed_removal_suggestions
-        })
+        return jsonify(process_upload(src_path, request.host_url, **options))
 
     return jsonify({'status': 0})
 
+def parse_pipeline_options(form):
+    """
+    Read the processing options of an upload request.
+
+    Parameters:
+    form (dict): The request form, with the optional fields 'export' (e.g. "geotiff,geojson"), 'export_dtype',
+                 'sparse' and 'nan_policy'.
+
+    Returns:
+    dict: The keyword arguments for process_upload(), or None if an option is unsupported.
+    """
+    export_formats = [f.strip().lower() for f in form.get('export', '').split(',') if f.strip()]
+    export_dtype = form.get('export_dtype', 'int8')
+    nan_policy = form.get('nan_policy', 'mask')
+    if any(f not in core.export.EXPORT_FORMATS for f in export_formats) or export_dtype not in core.export.NODATA:
+        return None
+    if nan_policy not in NAN_POLICIES:
+        return None
+    return {
+        'export_formats': export_formats,
+        'export_dtype': export_dtype,
+        'sparse_inference': form.get('sparse') in ('1', 'true'),
+        'nan_policy': nan_policy
+    }
+
+def process_upload(src_path, host_url, export_formats=(), export_dtype='int8', sparse_inference=False,
+                   nan_policy='mask'):
+    """
+    Run the full pipeline on an uploaded ZIP file that is already on disk: extraction, index calculation,
+    prediction, GPT analysis and saving of the result images.
+
+    Parameters:
+    src_path (str): Path of the uploaded ZIP file.
+    host_url (str): Root URL of the server, used to build the result URLs.
+    export_formats (iterable): Mask export formats, see core.export.EXPORT_FORMATS.
+    export_dtype (str): Quantization of the exported GeoTIFF.
+    sparse_inference (bool): If True, skip tiles without vegetation.
+    nan_policy (str): Handling of pixels with a missing index value, 'mask' or 'fill'.
+
+    Returns:
+    dict: The JSON-serialisable upload response.
+    """
+    # Extract ZIP file
+    with zipfile.ZipFile(src_path, 'r') as zip_ref:
+        zip_ref.extractall('./tmp/ct')
+
+    folder_name = get_single_folder_name_from_zip(src_path)
+    print("folder_name", folder_name)
+    output_folder = os.path.join('./tmp/ct', folder_name)
+
+    print("src_path, output_folder", src_path, output_folder)
+
+    # Process images and calculate indices
+    process_zip_and_calculate_indices(src_path, output_folder)
+
+    # Call other processing logic
+    pid, input_images, predicted_mask, image_info, spectrum_names, exports, inference_stats = core.main.c_main(
+        output_folder, current_app.model, export_formats, current_app.config['EXPORT_FOLDER'], export_dtype,
+        sparse_inference, current_app.tile_cache, nan_policy)
+
+    print("openai-version", openai.__version__)
+
+    # Analyze image_info using GPT to get weed removal suggestions
+    analysis_prompt = f"""
+    The DPIRD AgriVision platform is an expert platform developed by the Department of Agriculture of Western Australia, designed for further analysis of
+    weed identification results and providing AI-driven professional advice. You are now serving as a professional agricultural consultant on this
+    platform. Based on the weed information from the test field we provide, combined with your professional agricultural knowledge and the remote
+    sensing knowledge base, please provide detailed explanations and analysis. Additionally, give guidance tailored to the specific conditions of
+    Western Australia (such as environment, climate, soil, rainfall, etc.). If there is a high weed density, provide a clear warning based on the
+    national context of Australia, and offer advanced analysis.
+    The image shows {image_info['Vegetation']} vegetation, {image_info['Weed']} weed, and {image_info['Misc/Other']} miscellaneous or other elements. 
+    Attention: Don't have markdown formatting. Do not bold text. No "*" in output. Different points suggest subparagraphs.
+    """
+    weed_removal_suggestions = analyze_text(analysis_prompt)
+    print("suggestions", weed_removal_suggestions)
+
+    # Create directories if they don't exist
+    os.makedirs('./tmp/input', exist_ok=True)
+    os.makedirs('./tmp/draw', exist_ok=True)
+
+    # Save all input images and the predicted mask
+    input_image_urls = []
+    for img, name in zip(input_images, spectrum_names):
+        input_image_path = f'./tmp/input/{pid}_{name}.png'
+        img.save(input_image_path)
+        input_image_urls.append(f'{host_url}tmp/input/{pid}_{name}.png')
+
+    predicted_mask_path = f'./tmp/draw/{pid}_predicted.png'
+    predicted_mask.save(predicted_mask_path)
+
+    return {
+        'status': 1,
+        'pid': pid,
+        'field': folder_name,
+        'input_image_urls': input_image_urls,
+        'spectrum_names': spectrum_names,
+        'predicted_mask_url': f'{host_url}tmp/draw/{pid}_predicted.png',
+        'image_info': image_info,
+        'weed_removal_suggestions': weed_removal_suggestions,
+        'export_urls': {fmt: f'{host_url}export/{name}' for fmt, name in exports.items()},
+        'inference_stats': inference_stats
+    }
+
+def _write_result(job_id, result, folder=None):
+    """
+    Store the response of a progressive upload for /result/<job_id>.
+    Written then renamed, so that /result never reads a half-written file.
+
+    Parameters:
+    job_id (str): The id returned with the preview.
+    result (dict): The JSON-serialisable response.
+    folder (str): The result folder. Default is RESULT_FOLDER of the current app.
+    """
+    result_path = os.path.join(folder or current_app.config['RESULT_FOLDER'], f'{job_id}.json')
+    with open(result_path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(result_path + '.tmp', result_path)
+
+def _release_background_job():
+    global _background_jobs
+    with _background_lock:
+        _background_jobs -= 1
+
+def start_progressive_upload(src_path, host_url, **options):
+    """
+    Return a quick preview of an uploaded ZIP file and continue with the full-resolution pipeline in the background.
+    The preview reads the bands decimated to the model input size straight from the zip file, so it skips the
+    extraction, the index .tif files and the full-resolution reads.
+    At most PROGRESSIVE_BACKLOG full-resolution runs are queued or running per worker process; beyond that the upload
+    is refused, like a regular upload on a saturated server.
+
+    Parameters:
+    src_path (str): Path of the uploaded ZIP file.
+    host_url (str): Root URL of the server, used to build the result URLs.
+    options: Processing options for the full-resolution run, see parse_pipeline_options().
+
+    Returns:
+    dict: The JSON-serialisable preview response, including the URL to poll for the full results,
+          or None if the background queue is full.
+    """
+    global _background_jobs
+    with _background_lock:
+        if _background_jobs >= current_app.config['PROGRESSIVE_BACKLOG']:
+            return None
+        _background_jobs += 1
+
+    try:
+        job_id = str(uuid.uuid4())
+        os.makedirs(current_app.config['RESULT_FOLDER'], exist_ok=True)
+        os.makedirs('./tmp/draw', exist_ok=True)
+
+        start = time.time()
+        indices = calculate_preview_indices(src_path, current_app.model.input_shape[1:3])
+        preview_mask, image_info = core.main.c_preview(indices, current_app.model)
+        preview_mask.save(f'./tmp/draw/{job_id}_preview.png')
+        print(f"Preview ready in {time.time() - start:.2f}s")
+
+        # Pending marker naming the worker process, so /result can tell a run that died with its worker
+        _write_result(job_id, {'status': 2, 'pid': os.getpid()})
+
+        app = current_app._get_current_object()
+        threading.Thread(target=_run_full_resolution, args=(app, job_id, src_path, host_url, request_user(), options),
+                         daemon=True).start()
+    except Exception:
+        _release_background_job()
+        raise
+
+    return {
+        'status': 1,
+        'preview': True,
+        'predicted_mask_url': f'{host_url}tmp/draw/{job_id}_preview.png',
+        'image_info': image_info,
+        'result_url': f'{host_url}result/{job_id}'
+    }
+
+def _run_full_resolution(app, job_id, src_path, host_url, user, options):
+    """
+    Run the full-resolution pipeline for a progressive upload and store its response for /result/<job_id>.
+    The run queues for a pipeline slot like any other upload, without a timeout, as its place in the background
+    queue was already reserved.
+
+    Parameters:
+    app (Flask app object): The application, as the thread runs outside the request.
+    job_id (str): The id returned with the preview.
+    src_path, host_url: As for process_upload().
+    user (str): The user who uploaded the file, for scheduling.
+    options (dict): Processing options, see parse_pipeline_options().
+    """
+    try:
+        with app.app_context():
+            ticket = app.pipeline_scheduler.acquire(user, os.path.getsize(src_path))
+            try:
+                result = process_upload(src_path, host_url, **options)
+            except Exception as e:
+                print(f"Full-resolution processing of {job_id} failed: {e}")
+                result = {'status': 0, 'message': f"Error: {str(e)}"}
+            finally:
+                app.pipeline_scheduler.release(ticket)
+
+            _write_result(job_id, result, app.config['RESULT_FOLDER'])
+    finally:
+        _release_background_job()
+
+@file_ops_bp.route('/result/<job_id>', methods=['GET'])
+def get_result(job_id):
+    """
+    Serves the full-resolution results of a progressive upload.
+
+    Parameters:
+    job_id (str): The id returned with the preview.
+
+    Returns:
+    JSON response: The same response as /upload once ready, status 2 while still processing, or status 0 if the
+                   worker process running it was recycled or killed before it finished.
+    """
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return jsonify({'status': 0, 'message': 'Unknown result'}), 404
+
+    result_path = os.path.join(current_app.config['RESULT_FOLDER'], f'{job_id}.json')
+    if not os.path.exists(result_path):
+        return jsonify({'status': 0, 'message': 'Unknown result'}), 404
+    with open(result_path) as f:
+        result = json.load(f)
+
+    if result['status'] == 2:
+        if not pid_alive(result['pid']):
+            return jsonify({'status': 0, 'message': 'Full-resolution processing was interrupted, please upload again'})
+        return jsonify({'status': 2, 'message': 'Full-resolution results are still processing'})
+    return jsonify(result)
+
 @file_ops_bp.route("/download", methods=['GET'])
 def download_file():
     """
@@ -110,6 +337,19 @@ def download_file():
     """
     return send_from_directory('data', 'testfile.zip', as_attachment=True)
 
+@file_ops_bp.route('/export/<path:file>', methods=['GET'])
+def download_export(file):
+    """
+    Serves the exported GeoTIFF and GeoJSON files of a prediction as downloads.
+
+    Parameters:
+    file (str): The name of the exported file in the export folder.
+
+    Returns:
+    Flask response: The requested file as an attachment.
+    """
+    return send_from_directory(os.path.abspath(current_app.config['EXPORT_FOLDER']), file, as_attachment=True)
+
 @file_ops_bp.route('/tmp/<path:file>', methods=['GET'])
 def show_photo(file):
     """
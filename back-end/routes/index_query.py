@@ -0,0 +1,238 @@
+# This script serves vegetation indices of already ingested fields on demand, without running the prediction pipeline.
+# The main features include:
+# 1. Computing the requested indices (e.g. NDVI, GNDVI, MSAVI) over a pixel window or a bounding box of the field,
+#    at a requested resolution, reading only that window of each band (see calculate_window_indices).
+# 2. Returning summary statistics per index as JSON, or one index rendered as a colour-mapped PNG tile.
+# 3. Keeping the most recent results in a small in-memory cache, so repeated queries (e.g. a map re-requesting the
+#    same tile) skip the reads. Entries are tied to the modification times of the band files, so a re-uploaded
+#    field is never served stale results.
+# A field is identified by the folder name of its uploaded zip file, returned as 'field' by /upload.
+
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import matplotlib.image as mimage
+import rasterio
+from rasterio.errors import WindowError
+from rasterio.windows import Window, from_bounds, bounds as window_bounds
+from flask import Blueprint, jsonify, request, send_file
+from .process_indices import field_band_paths, calculate_window_indices
+
+index_query_bp = Blueprint('index_query', __name__)
+
+FIELD_FOLDER = './tmp/ct'
+
+# Indices that can be queried, as calculated by calculate_indices
+QUERY_INDICES = ('GNDVI', 'SAVI', 'MSAVI', 'ExG', 'ExR', 'PRI', 'MGRVI', 'NDVI', 'EVI', 'REIP', 'CI', 'OSAVI', 'TVI',
+                 'MCARI', 'TCARI')
+
+# Largest number of output pixels per query; larger requests are decimated to fit
+MAX_QUERY_PIXELS = 2048 * 2048
+
+# Number of query results kept in memory, per worker process
+QUERY_CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_get(key):
+    with _cache_lock:
+        if key not in _cache:
+            return None
+        _cache.move_to_end(key)
+        return _cache[key]
+
+def _cache_put(key, value):
+    with _cache_lock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > QUERY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def _floats(value, count, name):
+    """
+    Parse a comma-separated list of numbers from a query parameter.
+
+    Parameters:
+    value (str): The parameter value.
+    count (int): The expected number of values.
+    name (str): The parameter name, for the error message.
+
+    Returns:
+    list: The parsed numbers.
+    """
+    try:
+        numbers = [float(v) for v in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise ValueError(f"'{name}' must be {count} comma-separated numbers")
+    return numbers
+
+def resolve_window(src, args):
+    """
+    Work out the pixel window and output shape of a query from its parameters.
+
+    Parameters:
+    src (rasterio.DatasetReader): A band of the field, used for its size and transform.
+    args (dict): The query parameters: 'window' (col_off,row_off,width,height in pixels) or 'bbox'
+                 (minx,miny,maxx,maxy in the field's CRS), and 'resolution' (CRS units per output pixel).
+                 The whole field at native resolution is used by default.
+
+    Returns:
+    rasterio.windows.Window: The window, clipped to the field.
+    tuple: The (height, width) of the output.
+    """
+    field = Window(0, 0, src.width, src.height)
+    if args.get('window'):
+        window = Window(*_floats(args['window'], 4, 'window'))
+    elif args.get('bbox'):
+        window = from_bounds(*_floats(args['bbox'], 4, 'bbox'), transform=src.transform)
+    else:
+        window = field
+
+    try:
+        window = window.round_offsets().round_lengths().intersection(field)
+    except WindowError:
+        raise ValueError("The requested area does not overlap the field")
+    if window.width < 1 or window.height < 1:
+        raise ValueError("The requested area does not overlap the field")
+
+    # Scale relative to the native pixel size, never finer than native, and capped at MAX_QUERY_PIXELS
+    scale = 1.0
+    if args.get('resolution'):
+        resolution = _floats(args['resolution'], 1, 'resolution')[0]
+        if resolution <= 0:
+            raise ValueError("'resolution' must be positive")
+        scale = max(abs(src.transform.a) / resolution, abs(src.transform.e) / resolution)
+    scale = min(scale, 1.0, math.sqrt(MAX_QUERY_PIXELS / (window.width * window.height)))
+    out_shape = (max(1, round(window.height * scale)), max(1, round(window.width * scale)))
+    return window, out_shape
+
+def index_statistics(data):
+    """
+    Summarize an index over the valid (finite) pixels.
+
+    Parameters:
+    data (numpy.ndarray): The index values.
+
+    Returns:
+    dict: Valid pixel count, nodata fraction, min, max, mean, standard deviation and 10th/50th/90th percentiles.
+    """
+    valid = data[np.isfinite(data)]
+    stats = {'valid_pixels': int(valid.size), 'nodata_fraction': round(1 - valid.size / max(data.size, 1), 4)}
+    if valid.size == 0:
+        return stats
+    p10, p50, p90 = np.percentile(valid, [10, 50, 90])
+    stats.update({
+        'min': float(valid.min()),
+        'max': float(valid.max()),
+        'mean': float(valid.mean()),
+        'std': float(valid.std()),
+        'p10': float(p10),
+        'p50': float(p50),
+        'p90': float(p90),
+    })
+    return stats
+
+def render_index(data, vmin=None, vmax=None):
+    """
+    Render an index as a colour-mapped PNG, with nodata pixels transparent.
+
+    Parameters:
+    data (numpy.ndarray): The index values.
+    vmin, vmax (float): Colour scale limits; the 2nd and 98th percentiles of the valid pixels by default.
+
+    Returns:
+    bytes: The PNG image.
+    """
+    masked = np.ma.masked_invalid(data)
+    if masked.count():
+        low, high = np.percentile(masked.compressed(), [2, 98])
+        vmin = low if vmin is None else vmin
+        vmax = high if vmax is None else vmax
+
+    buf = io.BytesIO()
+    mimage.imsave(buf, masked, cmap='RdYlGn', vmin=vmin, vmax=vmax, format='png')
+    return buf.getvalue()
+
+@index_query_bp.route('/fields/<field>/indices', methods=['GET'])
+def query_indices(field):
+    """
+    Computes vegetation indices over an area of an already ingested field.
+
+    Parameters:
+    field (str): The field name, i.e. the folder name of the uploaded zip file.
+
+    Query parameters:
+    indices (str): Comma-separated index names. Default is 'NDVI'.
+    window (str): col_off,row_off,width,height of the area in pixels.
+    bbox (str): minx,miny,maxx,maxy of the area in the field's CRS, used when 'window' is absent.
+    resolution (float): Output pixel size in CRS units. Default is the native resolution.
+    format (str): 'stats' for summary statistics (default), or 'png' to render a single index.
+    vmin, vmax (float): Colour scale limits of the 'png' format.
+
+    Returns:
+    JSON response or PNG image: The statistics per index with the area actually read, or the rendered tile.
+    """
+    folder = os.path.join(FIELD_FOLDER, os.path.basename(field))
+    band_paths = field_band_paths(folder) if os.path.isdir(folder) else {}
+    if len(band_paths) < 5:
+        return jsonify({'status': 0, 'message': 'Unknown field'}), 404
+
+    names = tuple(dict.fromkeys(n.strip() for n in request.args.get('indices', 'NDVI').split(',') if n.strip()))
+    unsupported = [n for n in names if n not in QUERY_INDICES]
+    output = request.args.get('format', 'stats')
+    if not names or unsupported:
+        return jsonify({'status': 0, 'message': f"Unsupported indices: {', '.join(unsupported)}; "
+                                                f"choose from {', '.join(QUERY_INDICES)}"}), 400
+    if output not in ('stats', 'png'):
+        return jsonify({'status': 0, 'message': "'format' must be 'stats' or 'png'"}), 400
+    if output == 'png' and len(names) != 1:
+        return jsonify({'status': 0, 'message': "The 'png' format renders exactly one index"}), 400
+
+    try:
+        limits = tuple(_floats(request.args[k], 1, k)[0] if request.args.get(k) else None for k in ('vmin', 'vmax'))
+        with rasterio.open(band_paths['nir']) as src:
+            window, out_shape = resolve_window(src, request.args)
+            crs = src.crs.to_string() if src.crs else None
+            area = window_bounds(window, src.transform)
+            resolution = abs(src.transform.a) * window.width / out_shape[1]
+    except ValueError as e:
+        return jsonify({'status': 0, 'message': str(e)}), 400
+
+    # Band modification times tie cached results to the current upload of the field
+    version = tuple(os.path.getmtime(path) for _, path in sorted(band_paths.items()))
+    window_key = tuple(int(v) for v in (window.col_off, window.row_off, window.width, window.height))
+    key = (folder, version, names, window_key, out_shape, output, limits)
+
+    result = _cache_get(key)
+    cached = result is not None
+    if not cached:
+        indices = calculate_window_indices(band_paths, window, out_shape)
+        if output == 'png':
+            result = render_index(indices[names[0]], *limits)
+        else:
+            result = {name: index_statistics(indices[name]) for name in names}
+        _cache_put(key, result)
+
+    if output == 'png':
+        response = send_file(io.BytesIO(result), mimetype='image/png')
+        response.headers['X-Cache'] = 'hit' if cached else 'miss'
+        return response
+
+    return jsonify({
+        'status': 1,
+        'field': os.path.basename(field),
+        'crs': crs,
+        'bounds': area,
+        'window': dict(zip(('col_off', 'row_off', 'width', 'height'), window_key)),
+        'shape': out_shape,
+        'resolution': resolution,
+        'cached': cached,
+        'statistics': result,
+    })
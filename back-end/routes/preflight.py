@@ -0,0 +1,109 @@
+# This script validates an uploaded zip file before any heavy work is done on it.
+# Only metadata is read: the zip central directory and the GeoTIFF headers (through GDAL's /vsizip/), never pixel data.
+# The checks mirror what the pipeline later relies on:
+# 1. The zip holds a top-level folder containing the Blue, Green, Red, NIR and RedEdge bands and an RGB_ image.
+# 2. Every band is a readable GeoTIFF with an integer or floating-point dtype, and the RGB image has at least three bands.
+# 3. All images share the same dimensions and, when georeferenced, the same CRS.
+# 4. Nodata values are reported, with a warning when the bands disagree.
+
+import os
+import time
+import zipfile
+import numpy as np
+import rasterio
+from rasterio.errors import RasterioIOError
+from .process_indices import band_name, select_band_files
+
+REQUIRED_BANDS = ['blue', 'green', 'red', 'nir', 're']
+
+
+def _folder_of(zip_ref):
+    """
+    Return the name of the first directory entry of a zip file, as the pipeline extracts and processes that folder.
+
+    Parameters:
+    zip_ref (zipfile.ZipFile): The open zip file.
+
+    Returns:
+    str: The folder path inside the zip, with a trailing slash, or None if there is no directory entry.
+    """
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            return info.filename
+    return None
+
+def validate_upload_zip(zip_file_path):
+    """
+    Check that an uploaded zip file has everything the pipeline needs, using only metadata.
+
+    Parameters:
+    zip_file_path (str): Path to the uploaded zip file.
+
+    Returns:
+    dict: 'valid' (bool), 'errors' and 'warnings' (lists of str), 'images' (header summary per band) and 'elapsed_ms'.
+    """
+    start = time.perf_counter()
+    errors = []
+    images = {}
+
+    try:
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+            folder = _folder_of(zip_ref)
+            names = [n for n in zip_ref.namelist() if n.lower().endswith(('.tif', '.tiff'))]
+    except zipfile.BadZipFile:
+        return {'valid': False, 'errors': ['The file is not a valid zip archive'], 'warnings': [], 'images': {},
+                'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)}
+
+    if folder is None:
+        errors.append('The zip must contain a folder with the band images')
+        folder = ''
+
+    # Pick the band images inside the processed folder with the pipeline's own selection;
+    # the RGB image is looked up by its prefix
+    candidates = [name for name in names if name.startswith(folder) and
+                  (band_name(os.path.basename(name)) != 'rgb' or os.path.basename(name).startswith('RGB_'))]
+    members = select_band_files(candidates)
+
+    missing = [band for band in REQUIRED_BANDS + ['rgb'] if band not in members]
+    if missing:
+        errors.append(f"Missing band images: {', '.join(missing)}")
+
+    archive = os.path.abspath(zip_file_path)
+    for band, name in members.items():
+        try:
+            with rasterio.open(f'zip://{archive}!/{name}') as src:
+                images[band] = {
+                    'file': name,
+                    'width': src.width,
+                    'height': src.height,
+                    'count': src.count,
+                    'dtype': src.dtypes[0],
+                    'crs': src.crs.to_string() if src.crs else None,
+                    'nodata': src.nodata,
+                }
+        except RasterioIOError as e:
+            errors.append(f"{name} is not a readable GeoTIFF: {e}")
+
+    for band, image in images.items():
+        if np.dtype(image['dtype']).kind not in 'iuf':
+            errors.append(f"{image['file']} has unsupported dtype {image['dtype']}")
+        if band == 'rgb' and image['count'] < 3:
+            errors.append(f"{image['file']} must have 3 bands, found {image['count']}")
+
+    shapes = {(image['height'], image['width']) for image in images.values()}
+    if len(shapes) > 1:
+        errors.append('Band images have different dimensions: ' +
+                      ', '.join(f"{band} {image['height']}x{image['width']}" for band, image in images.items()))
+
+    crs = {image['crs'] for image in images.values() if image['crs']}
+    if len(crs) > 1:
+        errors.append(f"Band images have different CRS: {', '.join(sorted(crs))}")
+
+    warnings = []
+    nodata = {str(image['nodata']) for band, image in images.items() if band != 'rgb'}  # str() so NaNs compare equal
+    if len(nodata) > 1:
+        warnings.append(f"Band images have different nodata values: {', '.join(sorted(nodata))}")
+
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+    print(f"Pre-flight validation of {zip_file_path} took {elapsed_ms} ms, {len(errors)} error(s)")
+    return {'valid': not errors, 'errors': errors, 'warnings': warnings, 'images': images, 'elapsed_ms': elapsed_ms}
@@ -3,13 +3,18 @@
 # 1. Extract the uploaded zip file to a specified folder.
 # 2. Identify and load specific image bands such as Blue, Green, Red, Near-Infrared (NIR), and Red-Edge.
 # 3. Calculate a set of vegetation indices (e.g., NDVI, GNDVI, SAVI, etc.) based on the loaded image bands.
-# 4. Save the calculated indices as .tif files in the output folder for further analysis or use.
+# 4. Save the calculated indices as .tif files in the output folder for further analysis or use, tagged with their
+#    value range so that they can be normalized later without another pass over the pixels.
+# 5. Calculate the indices at a reduced resolution straight from the zip file for a quick preview.
+# 6. Calculate the indices over a window of an already extracted field, reading only that window of each band.
 
 
 import os
 import zipfile
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
+from core.normalize import finite_min_max, statistics_tags
 
 # Extract and process the uploaded zip file, calculating vegetation indices from the extracted images.
 def process_zip_and_calculate_indices(zip_file_path, output_folder):
@@ -28,44 +33,157 @@ def process_zip_and_calculate_indices(zip_file_path, output_folder):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    # Define variables for image bands
-    blue, green, red, nir, re = None, None, None, None, None
-
-    # Traverse extracted files and read images based on band type
-    for root, dirs, files in os.walk(output_folder):
-        for file in files:
-            file_path = os.path.join(root, file)
-            if "Blue" in file:
-                blue = rasterio.open(file_path).read(1)
-            elif "Green" in file:
-                green = rasterio.open(file_path).read(1)
-            elif "Red_" in file and "RedEdge" not in file:
-                red = rasterio.open(file_path).read(1)
-            elif "NIR" in file:
-                nir = rasterio.open(file_path).read(1)
-            elif "RedEdge" in file:
-                re = rasterio.open(file_path).read(1)
-            elif "RGB" in file:
-                print(f"RGB image found: {file_path}, no processing required.")
-                continue
-
-    # Ensure all required image bands are loaded
-    if any([blue is None, green is None, red is None, nir is None, re is None]):
+    # Pick the image of each band among the extracted files
+    file_paths = [os.path.join(root, file) for root, dirs, files in os.walk(output_folder) for file in files]
+    band_paths = select_band_files(file_paths)
+    if 'rgb' in band_paths:
+        print(f"RGB image found: {band_paths['rgb']}, no processing required.")
+
+    # Ensure all required image bands are present
+    if any(band not in band_paths for band in ('blue', 'green', 'red', 'nir', 're')):
         raise ValueError("One or more required images (blue, green, red, nir, re) are missing!")
 
+    # Read the bands in floating point with their nodata pixels as NaN, so that every index is NaN there and
+    # integer bands (e.g. uint16) cannot wrap around on subtraction
+    bands = {}
+    for band in ('blue', 'green', 'red', 'nir', 're'):
+        with rasterio.open(band_paths[band]) as src:
+            bands[band] = src.read(1, masked=True).astype(np.float32).filled(np.nan)
+            if band == 'nir':
+                source_crs, source_transform = src.crs, src.transform
+
     # Calculate vegetation indices
-    indices = calculate_indices(blue, green, red, nir, re)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        indices = calculate_indices(bands['blue'], bands['green'], bands['red'], bands['nir'], bands['re'])
 
-    # Assume a profile to save .tif files
+    # Georeference the indices like the source bands so exported masks line up with the field
     profile = {
-        'crs': rasterio.crs.CRS.from_epsg(4326),  # Example CRS, adjust as needed
-        'transform': rasterio.transform.from_origin(0, 0, 1, 1),  # Example transform, adjust as needed
+        'crs': source_crs or rasterio.crs.CRS.from_epsg(4326),  # Example CRS if the bands are not georeferenced
+        'transform': source_transform if source_crs else rasterio.transform.from_origin(0, 0, 1, 1),
     }
 
     # Save calculated indices as .tif files
     hor, cor = 1, 1  # Example values, replace with actual values if available
     save_indices_as_tif(indices, output_folder, hor, cor, profile)
 
+# Identify the band stored in a file from its name
+def band_name(file):
+    """
+    Identifies the band stored in a file from its name.
+
+    Parameters:
+    file (str): The file name.
+
+    Returns:
+    str: One of 'blue', 'green', 'red', 'nir', 're' and 'rgb', or None if the file is not a band image.
+    """
+    if "Blue" in file:
+        return 'blue'
+    elif "Green" in file:
+        return 'green'
+    elif "Red_" in file and "RedEdge" not in file:
+        return 'red'
+    elif "NIR" in file:
+        return 'nir'
+    elif "RedEdge" in file:
+        return 're'
+    elif "RGB" in file:
+        return 'rgb'
+    return None
+
+# Pick the image of each band among the files of a field
+def select_band_files(paths):
+    """
+    Picks the image of each band among the files of a field: the first file of each band in sorted path order.
+    Upload validation, index calculation, previews and index queries all select the bands with this function,
+    so they read the same files when a band appears more than once.
+
+    Parameters:
+    paths (iterable): Paths of the files, e.g. extracted files or zip member names.
+
+    Returns:
+    dict: A dictionary mapping each band found (see band_name) to its path.
+    """
+    selected = {}
+    for path in sorted(paths):
+        band = band_name(os.path.basename(path))
+        if band is not None and band not in selected:
+            selected[band] = path
+    return selected
+
+# Calculate low-resolution vegetation indices straight from the zip file for a quick preview
+def calculate_preview_indices(zip_file_path, out_shape):
+    """
+    Reads the bands directly from the zip file, without extracting it, decimated to the given shape
+    (rasterio uses the GeoTIFF overviews when present), and calculates the vegetation indices from them.
+
+    Parameters:
+    zip_file_path (str): Path to the zip file containing the images.
+    out_shape (tuple): The (height, width) to read each band at.
+
+    Returns:
+    dict: A dictionary of calculated vegetation indices at the reduced resolution.
+    """
+    bands = {}
+    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
+        names = [n for n in zip_ref.namelist() if n.lower().endswith('.tif')]
+
+    for band, name in select_band_files(names).items():
+        if band == 'rgb':
+            continue
+        with rasterio.open(f'zip://{os.path.abspath(zip_file_path)}!/{name}') as src:
+            bands[band] = src.read(1, out_shape=out_shape, resampling=Resampling.average).astype(np.float32)
+
+    missing = [b for b in ('blue', 'green', 'red', 'nir', 're') if b not in bands]
+    if missing:
+        raise ValueError(f"One or more required images ({', '.join(missing)}) are missing!")
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return calculate_indices(bands['blue'], bands['green'], bands['red'], bands['nir'], bands['re'])
+
+# Find the band images of an already extracted field
+def field_band_paths(folder):
+    """
+    Finds the band images of an extracted field, selected with select_band_files().
+
+    Parameters:
+    folder (str): Path to the extracted field folder.
+
+    Returns:
+    dict: A dictionary mapping each band ('blue', 'green', 'red', 'nir', 're') to its file path.
+    """
+    file_paths = [os.path.join(root, file) for root, dirs, files in os.walk(folder) for file in files]
+    paths = select_band_files(file_paths)
+    paths.pop('rgb', None)
+    return paths
+
+# Calculate vegetation indices over a window of the bands, resampled to the given shape
+def calculate_window_indices(band_paths, window, out_shape):
+    """
+    Reads only the given window of each band, resampled to the given shape (rasterio uses the GeoTIFF overviews
+    when present), and calculates the vegetation indices from it. Nodata pixels become NaN.
+
+    Parameters:
+    band_paths (dict): Band to file path, as returned by field_band_paths().
+    window (rasterio.windows.Window): The pixel window to read.
+    out_shape (tuple): The (height, width) to read the window at.
+
+    Returns:
+    dict: A dictionary of calculated vegetation indices over the window.
+    """
+    missing = [b for b in ('blue', 'green', 'red', 'nir', 're') if b not in band_paths]
+    if missing:
+        raise ValueError(f"One or more required images ({', '.join(missing)}) are missing!")
+
+    bands = {}
+    for band, path in band_paths.items():
+        with rasterio.open(path) as src:
+            data = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.average, masked=True)
+            bands[band] = data.astype(np.float32).filled(np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return calculate_indices(bands['blue'], bands['green'], bands['red'], bands['nir'], bands['re'])
+
 # Calculate various vegetation indices from the multispectral bands
 def calculate_indices(blue, green, red, nir, re):
     """
@@ -149,7 +267,8 @@ def calculate_indices(blue, green, red, nir, re):
 # Save the calculated indices as .tif files
 def save_indices_as_tif(indices, folder_path, hor, cor, profile):
     """
-    Saves the calculated vegetation indices as .tif files.
+    Saves the calculated vegetation indices as .tif files, with the minimum and maximum of their finite pixels
+    as GDAL statistics tags (read back by core.process.load_tif). Infinite values are saved as NaN, the nodata value.
 
     Parameters:
     indices (dict): Dictionary of vegetation indices to save.
@@ -165,7 +284,10 @@ def save_indices_as_tif(indices, folder_path, hor, cor, profile):
         tif_path = os.path.join(folder_path, f'{index_name}_{hor}_{cor}.tif')
         with rasterio.open(
                 tif_path, 'w', driver='GTiff', height=index_data.shape[0], width=index_data.shape[1],
-                count=1, dtype=index_data.dtype, crs=profile['crs'], transform=profile['transform']
+                count=1, dtype=index_data.dtype, crs=profile['crs'], transform=profile['transform'], nodata=np.nan
         ) as dst:
+            min_val, max_val, missing = finite_min_max(index_data)
             dst.write(index_data, 1)
+            if min_val is not None:
+                dst.update_tags(1, **statistics_tags(min_val, max_val, missing, index_data.size))
         print(f'Saved {tif_path}')
@@ -0,0 +1,208 @@
+# This script provides opt-in, per-request profiling of the processing pipeline for the DPIRD Intellicrop project.
+# The main features include:
+# 1. An admin-only switch: an upload is profiled only if it carries the X-Profile-Token header (or `profile` query
+#    parameter) matching the PROFILE_TOKEN setting. Without a configured token profiling is disabled entirely,
+#    and unprofiled requests pay nothing beyond the header lookup.
+# 2. Running the pipeline under cProfile and tracemalloc and storing, per prediction id, the raw profile
+#    together with a summary of the slowest functions, the time per library and the largest allocation sites.
+# 3. Endpoints that list the stored profiles and serve their summaries.
+# cProfile and tracemalloc are process-wide, so only one upload per worker process is profiled at a time; an upload
+# arriving while another is being profiled runs unprofiled and its response says so. Progressive uploads are not
+# profiled, as their full-resolution run continues in the background after the response.
+
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from flask import Blueprint, jsonify, request, current_app
+
+profiling_bp = Blueprint('profiling', __name__)
+
+# Number of functions and allocation sites kept in a summary
+TOP_ENTRIES = 30
+
+# Path fragments used to attribute time to the main libraries of the pipeline
+LIBRARIES = {
+    'rasterio': ('/rasterio/',),
+    'numpy': ('/numpy/',),
+    'tensorflow': ('/tensorflow/', '/keras/'),
+    'matplotlib': ('/matplotlib/', '/PIL/'),
+    'openai': ('/openai/', '/requests/', '/urllib3/'),
+}
+
+# Held while a run is being profiled in this process
+_profiling_lock = threading.Lock()
+
+
+def profiling_authorized():
+    """
+    Check whether the current request carries the admin profiling token, in the X-Profile-Token header
+    or the `profile` query parameter.
+
+    Returns:
+    bool: True if profiling is enabled and the token matches.
+    """
+    expected = current_app.config.get('PROFILE_TOKEN')
+    if not expected:
+        return False
+    token = request.headers.get('X-Profile-Token') or request.args.get('profile')
+    return token is not None and hmac.compare_digest(token, expected)
+
+def _library(filename):
+    """
+    Attribute a source file to one of the main libraries of the pipeline.
+
+    Parameters:
+    filename (str): The source file of a profiled function.
+
+    Returns:
+    str: The library name, 'builtins' for C functions without a file, or 'other'.
+    """
+    if filename == '~':
+        return 'builtins'
+    filename = filename.replace('\\', '/')
+    for library, fragments in LIBRARIES.items():
+        if any(fragment in filename for fragment in fragments):
+            return library
+    return 'other'
+
+def _summarize(profiler, snapshot, peak, elapsed):
+    """
+    Summarize a cProfile run and a tracemalloc snapshot.
+
+    Parameters:
+    profiler (cProfile.Profile): The finished profiler.
+    snapshot (tracemalloc.Snapshot): The allocations still alive at the end of the run.
+    peak (int): Peak traced memory in bytes.
+    elapsed (float): Wall-clock duration of the run in seconds.
+
+    Returns:
+    dict: The summary, with the top functions, the time per library and the top allocation sites.
+    """
+    stats = pstats.Stats(profiler).stats
+    functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_ENTRIES]
+
+    library_time = {}
+    for (filename, _, _), (_, _, total_time, _, _) in stats.items():
+        library = _library(filename)
+        library_time[library] = library_time.get(library, 0) + total_time
+
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+    ])
+
+    return {
+        'elapsed_seconds': round(elapsed, 3),
+        'peak_traced_mb': round(peak / 1024 ** 2, 2),
+        'time_per_library': {k: round(v, 3) for k, v in sorted(library_time.items(), key=lambda kv: -kv[1])},
+        'top_functions': [{
+            'function': f'{filename}:{line}({name})',
+            'calls': calls,
+            'total_time': round(total_time, 4),
+            'cumulative_time': round(cumulative_time, 4),
+        } for (filename, line, name), (_, calls, total_time, cumulative_time, _) in functions],
+        'top_allocations': [{
+            'site': str(stat.traceback[0]),
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count,
+        } for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]],
+    }
+
+def run_profiled(func, *args, **kwargs):
+    """
+    Run the pipeline under cProfile and tracemalloc and store the results under the prediction id it returns.
+    If another run is already being profiled in this process, the pipeline runs unprofiled instead of waiting.
+
+    Parameters:
+    func (function): The pipeline function, returning a response dict with a 'pid' key (e.g. process_upload).
+    args, kwargs: Arguments passed to func.
+
+    Returns:
+    dict: The pipeline response, with the URL of the stored profile added, or 'profile_skipped' set.
+    """
+    if not _profiling_lock.acquire(blocking=False):
+        result = func(*args, **kwargs)
+        result['profile_skipped'] = 'Another upload is being profiled by this worker'
+        return result
+
+    try:
+        # tracemalloc is process-wide; leave it running if someone else started it
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(10)
+        tracemalloc.reset_peak()
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            result = profiler.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+    finally:
+        _profiling_lock.release()
+
+    pid = result.get('pid')
+    if pid:
+        folder = current_app.config['PROFILE_FOLDER']
+        os.makedirs(folder, exist_ok=True)
+        profiler.dump_stats(os.path.join(folder, f'{pid}.prof'))  # Raw profile for snakeviz/pstats
+        with open(os.path.join(folder, f'{pid}.json'), 'w') as f:
+            json.dump(_summarize(profiler, snapshot, peak, elapsed), f)
+        result['profile_url'] = f'{request.host_url}profiles/{pid}'
+
+    return result
+
+@profiling_bp.route('/profiles', methods=['GET'])
+def list_profiles():
+    """
+    Lists the stored profiles, newest first. Requires the admin profiling token.
+
+    Returns:
+    JSON response: The prediction ids with stored profiles and their wall-clock durations.
+    """
+    if not profiling_authorized():
+        return jsonify({'status': 0, 'message': 'Forbidden'}), 403
+
+    folder = current_app.config['PROFILE_FOLDER']
+    if not os.path.isdir(folder):
+        return jsonify({'status': 1, 'profiles': []})
+
+    paths = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.json')]
+    profiles = []
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        with open(path) as f:
+            summary = json.load(f)
+        profiles.append({'pid': os.path.basename(path)[:-len('.json')], 'elapsed_seconds': summary['elapsed_seconds']})
+
+    return jsonify({'status': 1, 'profiles': profiles})
+
+@profiling_bp.route('/profiles/<pid>', methods=['GET'])
+def get_profile(pid):
+    """
+    Serves the summary of a stored profile: top functions, time per library and top allocation sites.
+    Requires the admin profiling token.
+
+    Parameters:
+    pid (str): The prediction id of the profiled upload.
+
+    Returns:
+    JSON response: The profile summary.
+    """
+    if not profiling_authorized():
+        return jsonify({'status': 0, 'message': 'Forbidden'}), 403
+
+    path = os.path.join(current_app.config['PROFILE_FOLDER'], f'{os.path.basename(pid)}.json')
+    if not os.path.exists(path):
+        return jsonify({'status': 0, 'message': 'Unknown profile'}), 404
+
+    with open(path) as f:
+        return jsonify({'status': 1, 'pid': pid, **json.load(f)})
@@ -0,0 +1,11 @@
+# This script is the production entry point of the DPIRD Intellicrop back-end.
+# It builds the Flask app at import time, so that gunicorn with `preload_app = True` does it once in the master
+# process before forking the workers (see gunicorn.conf.py).
+# No TensorFlow work happens here: each worker loads model1.h5 and warms up the inference graph after the fork.
+#
+# Run from the back-end directory with:
+#     gunicorn -c gunicorn.conf.py wsgi:app
+
+from app import create_app, prepare_app
+
+app = prepare_app(create_app(), load=False)